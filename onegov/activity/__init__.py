@@ -12,6 +12,7 @@ from onegov.activity.models import (
     Occasion,
     OccasionDate,
     OccasionNeed,
+    OccasionSearch,
     Period,
     PublicationRequest
 )
@@ -38,6 +39,7 @@ __all__ = [
     'Occasion',
     'OccasionDate',
     'OccasionNeed',
+    'OccasionSearch',
     'Period',
     'ActivityCollection',
     'AttendeeCollection',
@@ -3,7 +3,8 @@ import sedate
 
 from copy import copy
 from enum import IntEnum
-from onegov.activity.models import Activity, Occasion, OccasionDate, Period
+from onegov.activity.models import Activity, Occasion, OccasionDate
+from onegov.activity.models import OccasionSearch
 from onegov.activity.utils import date_range_decode
 from onegov.activity.utils import date_range_encode
 from onegov.activity.utils import merge_ranges
@@ -17,12 +18,16 @@ from onegov.core.utils import normalize_for_url
 from onegov.core.utils import toggle
 from sedate import utcnow
 from sqlalchemy import and_, or_, not_
+from sqlalchemy import cast
 from sqlalchemy import column
 from sqlalchemy import distinct
 from sqlalchemy import exists
 from sqlalchemy import func
+from sqlalchemy import literal
 from sqlalchemy import select
 from sqlalchemy import text
+from sqlalchemy import Text
+from sqlalchemy import union_all
 from sqlalchemy.dialects.postgresql import array
 from uuid import UUID
 
@@ -233,12 +238,6 @@ class ActivityCollection(Pagination):
             query = query.filter(
                 model_class.municipality.in_(self.filter.municipalities))
 
-        # occasion based filters
-        o = self.session.query(Occasion)\
-            .with_entities(Occasion.activity_id)\
-            .join(OccasionDate)\
-            .distinct()
-
         # if we are looking at activities without occasions, we do not have
         # to apply all the filters below which are occasion-based
         if 'undated' in self.filter.timelines:
@@ -256,6 +255,28 @@ class ActivityCollection(Pagination):
                     ).exists())
                 )
 
+        # occasion based filters
+        o = self.query_occasions()
+
+        # if no filter was applied to the occasion subquery, we ignore it since
+        # we would otherwise get zero results
+        if o._criterion is not None:
+            query = query.filter(model_class.id.in_(o.subquery()))
+
+        return query
+
+    def query_occasions(self):
+        """ Returns the search entries of the occasions matching the
+        occasion based filters (see :class:`onegov.activity.OccasionSearch`),
+        as a query of their activity ids.
+
+        The 'undated' timeline is not handled here, as it looks for
+        activities without occasions.
+
+        """
+
+        o = self.session.query(OccasionSearch.activity_id)
+
         now = utcnow()
 
         if self.filter.timelines:
@@ -276,42 +297,37 @@ class ActivityCollection(Pagination):
             # when we apply the occasion conditions to the activites query
             # since we'd be looking for activities without occasions
             if conditions:
-                o = o.filter(or_(*conditions))
+                o = o.filter(exists().where(and_(
+                    OccasionDate.occasion_id == OccasionSearch.occasion_id,
+                    or_(*conditions)
+                )))
 
         if self.filter.period_ids:
-            o = o.filter(Occasion.period_id.in_(self.filter.period_ids))
+            o = o.filter(OccasionSearch.period_id.in_(self.filter.period_ids))
 
         if self.filter.durations:
-            o = o.filter(Occasion.duration.in_(
+            o = o.filter(OccasionSearch.duration.in_(
                 int(d) for d in self.filter.durations))
 
         if self.filter.age_ranges:
             o = o.filter(or_(
                 *(
-                    Occasion.age.overlaps(func.int4range(min_age, max_age + 1))
+                    OccasionSearch.age.overlaps(
+                        func.int4range(min_age, max_age + 1))
                     for min_age, max_age in self.filter.age_ranges
                 )
             ))
 
         if self.filter.price_ranges:
-            o = o.join(Period)
             o = o.filter(or_(
                 *(
-                    and_(
-                        min_price <= (
-                            func.coalesce(Occasion.cost, 0)
-                            + func.coalesce(Period.occasion_extra_cost, 0)
-                        ),
-                        (
-                            func.coalesce(Occasion.cost, 0)
-                            + func.coalesce(Period.occasion_extra_cost, 0)
-                        ) <= max_price
-                    ) for min_price, max_price in self.filter.price_ranges
+                    OccasionSearch.price.between(min_price, max_price)
+                    for min_price, max_price in self.filter.price_ranges
                 )
             ))
 
         if self.filter.dateranges:
-            o = o.filter(Occasion.active_days.op('&&')(array(
+            o = o.filter(OccasionSearch.active_days.op('&&')(array(
                 tuple(
                     dt.toordinal()
                     for start, end in self.filter.dateranges
@@ -321,29 +337,142 @@ class ActivityCollection(Pagination):
 
         if self.filter.weekdays:
             o = o.filter(
-                Occasion.weekdays.op('&&')(array(self.filter.weekdays)))
+                OccasionSearch.weekdays.op('&&')(array(self.filter.weekdays)))
 
         if self.filter.available:
-            conditions = []
+            o = o.filter(
+                OccasionSearch.availability.in_(self.filter.available))
 
-            for amount in self.filter.available:
-                if amount == 'none':
-                    conditions.append(Occasion.available_spots == 0)
+        return o
 
-                elif amount == 'few':
-                    conditions.append(Occasion.available_spots.in_((1, 2, 3)))
+    def without_filter(self, key):
+        """ Returns a copy of the collection, without the filter of the
+        given key.
 
-                elif amount == 'many':
-                    conditions.append(Occasion.available_spots >= 4)
+        """
 
-            o = o.filter(or_(*conditions))
+        collection = copy(self)
+        collection.filter = copy(self.filter)
+        setattr(collection.filter, key, set())
 
-        # if no filter was applied to the occasion subquery, we ignore it since
-        # we would otherwise get zero results
-        if o._criterion is not None:
-            query = query.filter(model_class.id.in_(o.subquery()))
+        return collection
 
-        return query
+    def facets(self, age_ranges=None):
+        """ Returns the number of activities per value of the 'tags',
+        'durations', 'age_ranges', 'weekdays', 'municipalities' and
+        'available' filters, using a single statement::
+
+            {
+                'tags': {'Sport': 10, 'Music': 3},
+                'durations': {DAYS.half: 8},
+                ...
+            }
+
+        The count of a value is the number of activities which would be
+        found if the filter of its key was limited to that value, with all
+        other filters applied as usual. Values without activities are
+        omitted.
+
+        The age ranges are not known in advance, so they have to be given
+        as a list of (min, max) tuples. By default, the age ranges of the
+        current filter are counted.
+
+        Activities without occasions have no durations, age ranges,
+        weekdays or availability, so those are empty if the 'undated'
+        timeline is selected.
+
+        """
+
+        facets = (
+            'tags',
+            'durations',
+            'age_ranges',
+            'weekdays',
+            'municipalities',
+            'available'
+        )
+
+        if age_ranges is None:
+            age_ranges = self.filter.age_ranges
+
+        def count(key, values):
+            values = values.subquery()
+
+            return select([
+                literal(key).label('key'),
+                cast(values.c.value, Text).label('value'),
+                func.count(distinct(values.c.id)).label('count')
+            ]).where(values.c.value != None).group_by(values.c.value)
+
+        def activity_values(key, value):
+            collection = self.without_filter(key)
+            model_class = collection.model_class
+
+            return count(key, collection.query().with_entities(
+                model_class.id.label('id'),
+                value(model_class).label('value')
+            ))
+
+        def occasion_values(key, value, *conditions):
+            collection = self.without_filter(key)
+            model_class = collection.model_class
+
+            activities = collection.query().with_entities(model_class.id)
+            occasions = collection.query_occasions().filter(
+                OccasionSearch.activity_id.in_(activities.subquery()),
+                *conditions
+            )
+
+            return count(key, occasions.with_entities(
+                OccasionSearch.activity_id.label('id'),
+                value.label('value')
+            ))
+
+        queries = [
+            activity_values(
+                'tags', lambda model_class: func.skeys(model_class._tags)),
+            activity_values(
+                'municipalities', lambda model_class: model_class.municipality)
+        ]
+
+        if 'undated' not in self.filter.timelines:
+            queries.extend((
+                occasion_values('durations', OccasionSearch.duration),
+                occasion_values(
+                    'weekdays', func.unnest(OccasionSearch.weekdays)),
+                occasion_values('available', OccasionSearch.availability),
+            ))
+
+            queries.extend(
+                occasion_values(
+                    'age_ranges',
+                    literal(num_range_encode((min_age, max_age))),
+                    OccasionSearch.age.overlaps(
+                        func.int4range(min_age, max_age + 1))
+                )
+                for min_age, max_age in age_ranges
+            )
+
+        decode = {
+            'durations': int,
+            'weekdays': int,
+            'age_ranges': num_range_decode
+        }
+
+        result = {key: {} for key in facets}
+
+        # the statement has to see the pending changes of the session
+        self.session.flush()
+
+        for key, value, activities in self.session.execute(
+                union_all(*queries)):
+
+            if key in decode:
+                value = decode[key](value)
+
+            result[key][value] = activities
+
+        return result
 
     def for_filter(self, **keywords):
         """ Returns a new collection instance.
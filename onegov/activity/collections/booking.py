@@ -1,7 +1,10 @@
+from collections import defaultdict
 from onegov.activity.models import Booking, Period
 from onegov.core.collection import GenericCollection
 from onegov.activity.matching.utils import unblockable, booking_order
+from onegov.activity.matching.utils import overlaps
 from onegov.activity.errors import BookingLimitReached
+from sqlalchemy import func, or_
 from sqlalchemy.orm import joinedload
 
 
@@ -87,6 +90,29 @@ class BookingCollection(GenericCollection):
             period_id=occasion.period_id
         )
 
+    def _attendee_counts(self, occasion_ids):
+        """ Returns the number of accepted bookings of the given occasions,
+        as stored in the database.
+
+        The attendee count of loaded occasions is not updated when the
+        aggregate is updated on flush, so it can't be relied upon here.
+
+        """
+
+        counts = dict.fromkeys(occasion_ids, 0)
+
+        if not counts:
+            return counts
+
+        query = self.session.query(Booking.occasion_id, func.count(Booking.id))
+        query = query.filter(Booking.occasion_id.in_(counts))
+        query = query.filter(Booking.state == 'accepted')
+        query = query.group_by(Booking.occasion_id)
+
+        counts.update(query)
+
+        return counts
+
     def accept_booking(self, booking):
         """ Accepts the given booking, setting all other bookings which
         conflict with it to 'blocked'.
@@ -103,9 +129,6 @@ class BookingCollection(GenericCollection):
         if booking.occasion.full:
             raise RuntimeError("The occasion is already full")
 
-        if booking.state not in ('open', 'denied'):
-            raise RuntimeError("Only open/denied bookings can be accepted")
-
         bookings = tuple(
             self.session.query(Booking)
                 .options(joinedload(Booking.occasion))
@@ -114,7 +137,89 @@ class BookingCollection(GenericCollection):
                 .filter(Booking.id != booking.id)
         )
 
-        limit = booking.attendee.limit or booking.period.booking_limit
+        self.accept_with_bookings(booking, bookings)
+
+    def accept_bookings(self, bookings):
+        """ Accepts the given bookings in the given order, with the same
+        result as calling :meth:`accept_booking` for each of them.
+
+        The bookings of all affected attendees are loaded with a single
+        query and the changes are flushed once at the end.
+
+        Returns a dictionary with the error of each given booking, in the
+        given order. The error is None if the booking was accepted,
+        otherwise it is the exception :meth:`accept_booking` would have
+        raised. Bookings which could not be accepted are left unchanged.
+
+        """
+
+        bookings = tuple(bookings)
+
+        if not bookings:
+            return {}
+
+        # the counts have to include the pending changes of the session
+        self.session.flush()
+
+        query = self.session.query(Booking)
+        query = query.options(joinedload(Booking.occasion))
+        query = query.options(joinedload(Booking.attendee))
+        query = query.filter(Booking.attendee_id.in_(
+            {b.attendee_id for b in bookings}))
+        query = query.filter(Booking.period_id.in_(
+            {b.period_id for b in bookings}))
+
+        by_attendee = defaultdict(list)
+
+        for b in query:
+            by_attendee[b.attendee_id, b.period_id].append(b)
+
+        # the attendee count of the occasions is only updated on flush,
+        # so we keep track of it ourselves
+        taken = self._attendee_counts({b.occasion_id for b in bookings})
+        results = {}
+
+        for booking in bookings:
+            occasion = booking.occasion
+
+            try:
+                if not booking.period.confirmed:
+                    raise RuntimeError(
+                        "The period has not yet been confirmed")
+
+                if taken[occasion.id] >= occasion.max_spots:
+                    raise RuntimeError("The occasion is already full")
+
+                self.accept_with_bookings(booking, tuple(
+                    b for b in by_attendee[
+                        booking.attendee_id, booking.period_id]
+                    if b.id != booking.id
+                ))
+
+            except RuntimeError as e:
+                results[booking] = e
+            else:
+                results[booking] = None
+                taken[occasion.id] += 1
+
+        self.session.flush()
+
+        return results
+
+    def accept_with_bookings(self, booking, bookings):
+        """ Accepts the given booking, given the other bookings of the same
+        attendee in the same period. See :meth:`accept_booking`.
+
+        The period and the occasion of the booking are expected to have
+        been checked already.
+
+        """
+
+        if booking.state not in ('open', 'denied'):
+            raise RuntimeError("Only open/denied bookings can be accepted")
+
+        settings = booking.period.settings
+        limit = booking.attendee.limit or settings.booking_limit
 
         if limit and not booking.occasion.exempt_from_booking_limit:
             accepted = sum(
@@ -130,16 +235,19 @@ class BookingCollection(GenericCollection):
         else:
             block_rest = False
 
-        # block the overlapping bookings
-        for b in bookings:
-            if b.overlaps(booking):
-                if b.state == 'cancelled':
-                    continue
+        # find the overlapping bookings before changing anything
+        overlapping = tuple(
+            b for b in bookings if b.state != 'cancelled' and overlaps(
+                b, booking, settings.minutes_between, settings.alignment)
+        )
 
-                if b.state == 'accepted':
-                    raise RuntimeError("Conflict with booking {}".format(b.id))
+        for b in overlapping:
+            if b.state == 'accepted':
+                raise RuntimeError("Conflict with booking {}".format(b.id))
 
-                b.state = 'blocked'
+        # block the overlapping bookings
+        for b in overlapping:
+            b.state = 'blocked'
 
         # if we reached the limit, block *all* bookings
         if block_rest:
@@ -182,71 +290,161 @@ class BookingCollection(GenericCollection):
         booking is an accepted bookings. Open, cancelled, blocked and
         denied bookings can simply be deleted.
 
+        The bookings involved in the cascade are loaded with a single query,
+        the changes are flushed once at the end.
+
         """
 
         if not booking.period.confirmed:
             raise RuntimeError("The period has not yet been confirmed")
 
+        self.cancel_bookings((booking, ), score_function, cascade)
+
+    def cancel_bookings(self, bookings,
+                        score_function=booking_order, cascade=True):
+        """ Cancels the given bookings, computing the cascade of
+        :meth:`cancel_booking` for all of them at once.
+
+        The bookings unblocked by the cancellations are accepted in the
+        order of the score function, regardless of their attendee. The
+        freed spots of the occasions are then filled with waiting bookings,
+        unless the occasion has been cancelled.
+
+        The bookings involved in the cascade are loaded with a single query,
+        the changes are flushed once at the end.
+
+        """
+
+        bookings = tuple(bookings)
+
+        for booking in bookings:
+            if not booking.period.confirmed:
+                raise RuntimeError("The period has not yet been confirmed")
+
         # if the booking wasn't accepted or if we don't cascade, this is quick
-        if not cascade or booking.state != 'accepted':
+        cancelled = []
+
+        for booking in bookings:
+            if cascade and booking.state == 'accepted':
+                cancelled.append(booking)
+            else:
+                booking.state = 'cancelled'
+                booking.group_code = None
+
+        if not cancelled:
+            return
+
+        freed = {b.occasion for b in cancelled if not b.occasion.cancelled}
+
+        # make sure the attendee counts of the occasions are up to date
+        self.session.flush()
+
+        # load the bookings of the attendees as well as the bookings of all
+        # attendees waiting for the freed occasions at once, the cascade is
+        # then computed in memory and flushed at the end
+        attendees = Booking.attendee_id.in_(
+            {b.attendee_id for b in cancelled})
+
+        if freed:
+            waiting = self.session.query(Booking.attendee_id)
+            waiting = waiting.filter(
+                Booking.occasion_id.in_({o.id for o in freed}))
+            waiting = waiting.filter(Booking.state.in_(('open', 'denied')))
+
+            attendees = or_(
+                attendees, Booking.attendee_id.in_(waiting.subquery()))
+
+        query = self.session.query(Booking)
+        query = query.options(joinedload(Booking.occasion))
+        query = query.options(joinedload(Booking.attendee))
+        query = query.filter(Booking.period_id.in_(
+            {b.period_id for b in cancelled}))
+        query = query.filter(attendees)
+
+        by_attendee = defaultdict(list)
+
+        for b in query:
+            by_attendee[b.attendee_id].append(b)
+
+        # the attendee count of the occasions is only updated on flush,
+        # so we keep track of it ourselves
+        taken = self._attendee_counts({
+            b.occasion_id
+            for attendee_bookings in by_attendee.values()
+            for b in attendee_bookings
+        })
+
+        def count(occasion):
+            return taken[occasion.id]
+
+        for booking in cancelled:
+            taken[booking.occasion_id] = count(booking.occasion) - 1
             booking.state = 'cancelled'
             booking.group_code = None
-            return
 
-        bookings = tuple(
-            self.session.query(Booking)
-                .options(joinedload(Booking.occasion))
-                .filter(Booking.attendee_id == booking.attendee_id)
-                .filter(Booking.period_id == booking.period_id)
-                .filter(Booking.id != booking.id))
+        def accept(b):
+            if count(b.occasion) >= b.occasion.max_spots:
+                raise RuntimeError("The occasion is already full")
 
-        booking.state = 'cancelled'
-        booking.group_code = None
+            self.accept_with_bookings(b, tuple(
+                o for o in by_attendee[b.attendee_id] if o.id != b.id))
+
+            taken[b.occasion_id] += 1
 
         # mark the no-longer blocked bookings as denied
-        accepted = {b for b in bookings if b.state == 'accepted'}
-        blocked = {b for b in bookings if b.state == 'blocked'}
-        unblocked = set()
+        unblocked = []
 
-        if booking.period.all_inclusive:
-            limit = booking.period.booking_limit
-        else:
-            limit = booking.attendee.limit
+        for attendee_id in {b.attendee_id for b in cancelled}:
+            attendee_bookings = by_attendee[attendee_id]
 
-        unblockable_bookings = unblockable(accepted, blocked, score_function)
+            accepted = {b for b in attendee_bookings if b.state == 'accepted'}
+            blocked = {b for b in attendee_bookings if b.state == 'blocked'}
 
-        for cnt, booking in enumerate(unblockable_bookings, start=1):
+            settings = attendee_bookings[0].period.settings
 
-            if limit and limit < (cnt + len(accepted)):
-                break
+            if settings.all_inclusive:
+                limit = settings.booking_limit
+            else:
+                limit = attendee_bookings[0].attendee.limit
 
-            booking.state = 'denied'
-            unblocked.add(booking)
+            unblockable_bookings = unblockable(
+                accepted, blocked, score_function, settings=settings)
 
-        self.session.flush()
+            for cnt, b in enumerate(unblockable_bookings, start=1):
+
+                if limit and limit < (cnt + len(accepted)):
+                    break
+
+                b.state = 'denied'
+                unblocked.append(b)
 
         # try to accept the denied bookings in their respective occasions
-        for b in unblocked:
+        for b in sorted(unblocked, key=score_function):
 
             # the denied state changes during the loop execution
-            if b.state == 'denied' and not b.occasion.full:
-                self.accept_booking(b)
-                self.session.flush()
-
-        # try to accept the open/denied bookings in the current occasion
-        spots = booking.occasion.available_spots
-        denied_bookings = sorted(
-            (
-                b for b in booking.occasion.bookings
-                if b.state in ('open', 'denied')
-            ),
-            key=score_function)
-
-        for b in denied_bookings:
-            if spots:
-                try:
-                    self.accept_booking(b)
-                    self.session.flush()
-                    spots -= 1
-                except BookingLimitReached:
-                    pass
+            if b.state != 'denied':
+                continue
+
+            if count(b.occasion) < b.occasion.max_spots:
+                accept(b)
+
+        # try to accept the open/denied bookings in the freed occasions
+        waiting = defaultdict(list)
+
+        for attendee_bookings in by_attendee.values():
+            for b in attendee_bookings:
+                if b.occasion in freed and b.state in ('open', 'denied'):
+                    waiting[b.occasion].append(b)
+
+        for occasion in freed:
+            spots = occasion.max_spots - count(occasion)
+
+            for b in sorted(waiting[occasion], key=score_function):
+                if spots:
+                    try:
+                        accept(b)
+                        spots -= 1
+                    except BookingLimitReached:
+                        pass
+
+        self.session.flush()
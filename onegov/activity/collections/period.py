@@ -1,9 +1,16 @@
-from onegov.activity.models import Period
+from datetime import date
+from onegov.activity.models import Period, PeriodSnapshot
 from onegov.core.collection import GenericCollection
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
 
 
 class PeriodCollection(GenericCollection):
 
+    #: The snapshot of the active period by schema, shared by all
+    #: collections of the process (see :meth:`active_snapshot`)
+    active_periods = {}
+
     @property
     def model_class(self):
         return Period
@@ -26,5 +33,101 @@ class PeriodCollection(GenericCollection):
             cancellation_days=cancellation_days,
         )
 
+    @property
+    def schema(self):
+        return self.session.info.get('schema')
+
     def active(self):
-        return self.query().filter(Period.active == True).first()
+        """ Returns the active period or None.
+
+        The active period is remembered per schema (see
+        :meth:`active_snapshot`). As long as it stays active, it is then
+        loaded by primary key, which does not query the database at all if
+        the period is already present in the session.
+
+        """
+        snapshot = self.active_periods.get(self.schema)
+
+        if snapshot is not None:
+            period = self.session.query(Period).get(snapshot.id)
+
+            if period is not None and period.active \
+                    and period not in self.session.deleted:
+                return period
+
+        period = self.query().filter(Period.active == True).first()
+        self.remember_active(period)
+
+        return period
+
+    def active_snapshot(self):
+        """ Returns the active period as :class:`PeriodSnapshot` or None.
+
+        The snapshot is cached per schema for the whole process, so callers
+        which only need the settings or the phase of the active period do
+        not query the database. It is discarded at the end of the day and
+        whenever a period is changed through the ORM of this process (see
+        :func:`forget_active_period`). Changes made by other processes are
+        only seen once a period is changed in this one, or once
+        :meth:`active` notices that the period is no longer active.
+
+        """
+        schema = self.schema
+
+        if schema in self.active_periods:
+            snapshot = self.active_periods[schema]
+
+            if snapshot is None or snapshot.phase.day == date.today():
+                return snapshot
+
+        return self.remember_active(self.active())
+
+    def remember_active(self, period):
+        snapshot = period and PeriodSnapshot.from_period(period)
+
+        # the changes of an ongoing transaction are not seen by the others
+        if not self.session.info.get('changed_periods'):
+            self.active_periods[self.schema] = snapshot
+
+        return snapshot
+
+
+def forget_active_period(period):
+    """ Discards the cached snapshot of the active period of the schema of
+    the given period, or of all schemas if the period has no session.
+
+    The session of the period does not cache the snapshot again until its
+    transaction ends, at which point the snapshot is discarded once more,
+    as other sessions may have cached the previous state in the meantime.
+
+    """
+    session = object_session(period)
+
+    if session is None:
+        PeriodCollection.active_periods.clear()
+        return
+
+    PeriodCollection.active_periods.pop(session.info.get('schema'), None)
+    session.info['changed_periods'] = True
+
+    if not event.contains(
+            session, 'after_transaction_end', on_transaction_end):
+        event.listen(session, 'after_transaction_end', on_transaction_end)
+
+
+def on_transaction_end(session, transaction):
+    if transaction.parent is None and session.info.pop(
+            'changed_periods', False):
+        PeriodCollection.active_periods.pop(session.info.get('schema'), None)
+
+
+@event.listens_for(Period.active, 'set', propagate=True)
+def on_active_change(period, value, oldvalue, initiator):
+    forget_active_period(period)
+
+
+@event.listens_for(Period, 'after_insert', propagate=True)
+@event.listens_for(Period, 'after_update', propagate=True)
+@event.listens_for(Period, 'after_delete', propagate=True)
+def on_period_change(mapper, connection, period):
+    forget_active_period(period)
@@ -1,3 +1,4 @@
+from onegov.activity.matching.compact import compact_deferred_acceptance
 from onegov.activity.matching.core import deferred_acceptance
 from onegov.activity.matching.core import deferred_acceptance_from_database
 from onegov.activity.matching.interfaces import MatchableBooking
@@ -10,6 +11,7 @@ from onegov.activity.matching.score import PreferOrganiserChildren
 from onegov.activity.matching.score import Scoring
 
 __all__ = [
+    'compact_deferred_acceptance',
     'deferred_acceptance',
     'deferred_acceptance_from_database',
     'MatchableBooking',
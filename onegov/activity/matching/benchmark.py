@@ -0,0 +1,424 @@
+""" Benchmarks the matching on synthetic periods.
+
+The benchmark may be run from the command line::
+
+    python -m onegov.activity.matching.benchmark --attendees 2000
+
+Each run is appended to a file as a line of JSON (see ``--output``), along
+with the version of onegov.activity. Runs of different releases may then
+be compared to spot regressions (see ``--compare``).
+
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+from itertools import accumulate, groupby
+from onegov.activity.matching.core import deferred_acceptance
+from onegov.activity.matching.loader import BookingRecord, DateRange
+from onegov.activity.matching.loader import OccasionRecord
+from onegov.activity.matching.score import PreferGroups, PreferMotivated
+from onegov.activity.matching.score import Scoring
+from onegov.activity.matching.utils import MatchingStats
+from sedate import replace_timezone
+from uuid import UUID
+
+
+PHASES = ('scoring', 'setup', 'proposals', 'validity', 'total')
+
+
+class SyntheticPeriod(object):
+    """ A period with randomly generated occasions and bookings, using the
+    records of :mod:`onegov.activity.matching.loader`.
+
+    :attendees:
+        The number of attendees.
+
+    :wishes:
+        The number of bookings per attendee.
+
+    :spots:
+        The minimum and maximum number of spots per occasion.
+
+    :demand:
+        The number of wishes per available spot. With a demand above 1.0
+        there are more wishes than spots.
+
+    :dates:
+        The maximum number of dates per occasion.
+
+    :occasions_per_activity:
+        The maximum number of occasions per activity. Occasions of the
+        same activity share an anti-affinity group.
+
+    :groups:
+        The share of attendees which book in groups.
+
+    :days:
+        The number of days the period lasts.
+
+    :seed:
+        The seed of the random number generator, the same seed yields the
+        same period.
+
+    """
+
+    def __init__(self, attendees=1000, wishes=5, spots=(4, 16), demand=1.5,
+                 dates=2, occasions_per_activity=3, groups=0.1, days=14,
+                 seed=0):
+
+        self.parameters = {
+            'attendees': attendees,
+            'wishes': wishes,
+            'spots': tuple(spots),
+            'demand': demand,
+            'dates': dates,
+            'occasions_per_activity': occasions_per_activity,
+            'groups': groups,
+            'days': days,
+            'seed': seed,
+        }
+
+        self.random = random.Random(seed)
+        self.period_id = self.uuid()
+        self.start = replace_timezone(datetime(2019, 7, 1), 'UTC')
+
+        self.occasions = self.generate_occasions()
+        self.bookings = self.generate_bookings()
+
+    def uuid(self):
+        return UUID(int=self.random.getrandbits(128), version=4)
+
+    def generate_dates(self):
+        dates = []
+        day = self.random.randrange(self.parameters['days'])
+
+        for ix in range(self.random.randint(1, self.parameters['dates'])):
+            start = self.start + timedelta(
+                days=day + ix,
+                hours=self.random.randint(8, 14),
+                minutes=self.random.choice((0, 30)))
+
+            end = start + timedelta(hours=self.random.randint(1, 4))
+            dates.append(DateRange(start, end))
+
+        return tuple(dates)
+
+    def generate_occasions(self):
+        p = self.parameters
+
+        min_spots, max_spots = p['spots']
+        average = (min_spots + max_spots) / 2
+        count = max(1, round(p['attendees'] * p['wishes'] / p['demand']
+                             / average))
+
+        occasions = []
+
+        while len(occasions) < count:
+            activity_id = self.uuid()
+
+            for _ in range(self.random.randint(
+                    1, p['occasions_per_activity'])):
+
+                occasions.append(OccasionRecord(
+                    id=self.uuid(),
+                    max_spots=self.random.randint(min_spots, max_spots),
+                    exclude_from_overlap_check=self.random.random() < 0.05,
+                    activity_id=activity_id,
+                    period_id=self.period_id,
+                    dates=self.generate_dates()
+                ))
+
+        return occasions[:count]
+
+    def generate_bookings(self):
+        p = self.parameters
+        bookings = []
+
+        # popular occasions get more wishes than others
+        weights = list(accumulate(
+            self.random.paretovariate(2) for o in self.occasions))
+
+        wishes = min(p['wishes'], len(self.occasions))
+
+        attendee_ids = [self.uuid() for _ in range(p['attendees'])]
+        attendee_ids.sort()
+
+        for attendee_id in attendee_ids:
+            occasions = set()
+
+            while len(occasions) < wishes:
+                occasions.add(self.random.choices(
+                    self.occasions, cum_weights=weights)[0])
+
+            for occasion in occasions:
+                bookings.append(BookingRecord(
+                    id=self.uuid(),
+                    attendee_id=attendee_id,
+                    occasion_id=occasion.id,
+                    period_id=self.period_id,
+                    priority=self.random.choice((0, 0, 0, 1)),
+                    group_code=None,
+                    username=None,
+                    state='open',
+                    score=0,
+                    occasion=occasion
+                ))
+
+        # groups are formed by attendees booking the same occasion
+        by_occasion = {}
+
+        for booking in bookings:
+            by_occasion.setdefault(booking.occasion_id, []).append(booking)
+
+        for booking in bookings:
+            if booking.group_code or self.random.random() >= p['groups']:
+                continue
+
+            size = self.random.randint(2, 4)
+            candidates = by_occasion[booking.occasion_id]
+            group = self.random.sample(candidates, min(size, len(candidates)))
+            group_code = self.uuid().hex[:10]
+
+            for member in group:
+                member.group_code = member.group_code or group_code
+
+        return bookings
+
+    def scoring(self):
+        """ Returns the scoring used by the matching of the period. """
+
+        counts = {}
+
+        for booking in self.bookings:
+            if booking.group_code:
+                counts[booking.group_code] = counts.get(
+                    booking.group_code, 0) + 1
+
+        group_scores = {
+            code: max(.5, 1.0 - 0.2 * (count - 2))
+            + PreferGroups.unique_score_modifier(code)
+            for code, count in counts.items() if count > 1
+        }
+
+        return Scoring(criteria=[
+            PreferMotivated(),
+            PreferGroups(
+                lambda b: group_scores.get(b.group_code, 0),
+                boost_unprioritised=False
+            )
+        ])
+
+
+def measure(function):
+    """ Calls the given function and returns its result and the time it
+    took.
+
+    """
+
+    start = time.perf_counter()
+    result = function()
+
+    return result, time.perf_counter() - start
+
+
+def peak_memory(function):
+    """ Calls the given function and returns the peak memory allocated by it.
+
+    This is measured separately, as tracing the allocations slows down
+    the function considerably.
+
+    """
+
+    tracemalloc.start()
+
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(period, alignment=None, minutes_between=0, default_limit=None,
+              repeat=3):
+    """ Runs the matching of the given synthetic period and returns the
+    fastest run of each phase in seconds (see :class:`MatchingStats`), the
+    counters of the last run, as well as the peak memory of the matching
+    in bytes.
+
+    """
+
+    if repeat < 1:
+        raise ValueError("The matching has to be run at least once")
+
+    bookings = period.bookings
+    occasions = period.occasions
+    scoring = period.scoring()
+
+    options = {
+        'alignment': alignment,
+        'minutes_between': minutes_between,
+        'default_limit': default_limit,
+    }
+
+    def matching(stats=None):
+        return deferred_acceptance(
+            bookings, occasions,
+            score_function=scoring,
+            sort_bookings=False,
+            stats=stats,
+            **options
+        )
+
+    phases = {phase: float('inf') for phase in PHASES}
+
+    for _ in range(repeat):
+        stats = MatchingStats()
+        result, duration = measure(lambda: matching(stats))
+
+        for phase in PHASES:
+            if phase == 'total':
+                measured = duration
+            else:
+                measured = stats.phases.get(phase, 0)
+
+            phases[phase] = min(phases[phase], measured)
+
+    counters = stats.as_dict()
+    del counters['phases']
+
+    return {
+        'parameters': dict(period.parameters, **options),
+        'phases': phases,
+        'counters': counters,
+        'peak_memory': peak_memory(matching),
+        'occasions': len(occasions),
+        'accepted': len(result.accepted),
+    }
+
+
+def version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('onegov.activity').version
+    except Exception:
+        return 'unknown'
+
+
+def store(path, record):
+    """ Appends the given benchmark record to the given JSON lines file. """
+
+    record = dict(
+        record,
+        version=version(),
+        python=platform.python_version(),
+        date=datetime.utcnow().isoformat(),
+    )
+
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    return record
+
+
+def load(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(records):
+    """ Yields a line for each set of parameters, comparing the latest
+    run with the run before, per phase.
+
+    """
+
+    def key(record):
+        return json.dumps(record['parameters'], sort_keys=True)
+
+    for _, runs in groupby(sorted(records, key=key), key=key):
+        runs = sorted(runs, key=lambda r: r['date'])
+
+        if len(runs) < 2:
+            continue
+
+        before, after = runs[-2], runs[-1]
+
+        changes = ' '.join(
+            '{}: {:+.0%}'.format(
+                phase,
+                after['phases'][phase] / before['phases'][phase] - 1
+                if before['phases'][phase] else 0
+            )
+            for phase in PHASES
+        )
+
+        yield '{} ({} -> {}): {}'.format(
+            key(after), before['version'], after['version'], changes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--attendees', type=int, nargs='+', default=[1000])
+    parser.add_argument('--wishes', type=int, nargs='+', default=[5])
+    parser.add_argument('--spots', type=int, nargs=2, default=[4, 16])
+    parser.add_argument('--demand', type=float, default=1.5)
+    parser.add_argument('--dates', type=int, default=2)
+    parser.add_argument('--groups', type=float, default=0.1)
+    parser.add_argument('--alignment', choices=('day', ), default=None)
+    parser.add_argument('--minutes-between', type=int, default=0)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='matching-benchmark.jsonl')
+    parser.add_argument('--compare', action='store_true')
+
+    args = parser.parse_args(argv)
+
+    if args.repeat < 1:
+        parser.error("--repeat has to be at least 1")
+
+    if args.compare:
+        for line in compare(load(args.output)):
+            print(line)
+
+        return
+
+    for attendees in args.attendees:
+        for wishes in args.wishes:
+            period = SyntheticPeriod(
+                attendees=attendees,
+                wishes=wishes,
+                spots=args.spots,
+                demand=args.demand,
+                dates=args.dates,
+                groups=args.groups,
+                seed=args.seed
+            )
+
+            record = store(args.output, benchmark(
+                period,
+                alignment=args.alignment,
+                minutes_between=args.minutes_between,
+                default_limit=args.limit,
+                repeat=args.repeat
+            ))
+
+            print('{attendees} attendees, {wishes} wishes: {phases}, '
+                  '{peak:.1f} MiB'.format(
+                      attendees=attendees,
+                      wishes=wishes,
+                      phases=', '.join(
+                          '{} {:.3f}s'.format(p, record['phases'][p])
+                          for p in PHASES
+                      ),
+                      peak=record['peak_memory'] / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,314 @@
+""" Implements the matching algorithm of :mod:`onegov.activity.matching.core`
+on integer-indexed arrays.
+
+Instead of agents holding on to bookings and occasions, the bookings are
+turned into a handful of arrays once. The algorithm then only deals with
+integers, which keeps the memory footprint of large periods low.
+
+The bookings are indexed in the order of :func:`booking_order`, so the
+index of a booking is also its rank. That is, a lower index is preferred
+by the attendee as well as by the occasion (if the scores are the same).
+
+"""
+
+from array import array
+from collections import deque
+from heapq import heapify, heappop, heappush
+from itertools import groupby
+from onegov.activity.matching.score import Scoring, score_bookings
+from onegov.activity.matching.utils import anti_affinity_groups
+from onegov.activity.matching.utils import bits, booking_order, LoopBudget
+from onegov.activity.matching.utils import MatchingStats
+from onegov.activity.matching.utils import occasion_intervals, popcount
+from onegov.activity.utils import intervals_overlap
+from onegov.core.utils import Bunch
+
+
+def compact_deferred_acceptance(bookings, occasions,
+                                score_function=None,
+                                validity_check=True,
+                                hard_budget=True,
+                                default_limit=None,
+                                attendee_limits=None,
+                                minutes_between=0,
+                                alignment=None,
+                                sort_bookings=True,
+                                stats=None):
+    """ Matches bookings with occasions, with the same result as
+    :func:`onegov.activity.matching.core.deferred_acceptance`.
+
+    The parameters are the same as well, with the exception of the
+    stability check, which requires the agents of the original
+    implementation.
+
+    """
+    assert alignment in (None, 'day')
+
+    stats = stats or MatchingStats()
+
+    if sort_bookings:
+        bookings = sorted(bookings, key=lambda b: b.attendee_id)
+
+    attendee_limits = attendee_limits or {}
+
+    # pre-calculate the booking scores
+    with stats.phase('scoring'):
+        score_bookings(bookings, score_function or Scoring())
+
+    score_function = None
+
+    with stats.phase('setup'):
+        # the attendees are kept in the order of the given bookings
+        attendee_ids = [aid for aid, _ in groupby(
+            bookings, key=lambda b: b.attendee_id)]
+
+        attendee_index = {aid: ix for ix, aid in enumerate(attendee_ids)}
+
+        # index the occasions
+        occasions = tuple(occasions)
+        occasion_index = {o.id: ix for ix, o in enumerate(occasions)}
+
+        spots = array('l', (o.max_spots for o in occasions))
+        exclude = bytearray(o.exclude_from_overlap_check for o in occasions)
+
+        groups = anti_affinity_groups(occasions)
+        group = array('l', (
+            -1 if groups[o.id] is None else groups[o.id] for o in occasions
+        ))
+
+        intervals = [
+            occasion_intervals(o, minutes_between, alignment)
+            for o in occasions
+        ]
+
+        # index the bookings
+        bookings = sorted(bookings, key=booking_order)
+
+        score = array('d', (b.score for b in bookings))
+        occasion = array('l', (
+            occasion_index[b.occasion_id] for b in bookings))
+        attendee = array('l', (
+            attendee_index[b.attendee_id] for b in bookings))
+
+        # the bookings of each attendee, in the order of their wishlist, with
+        # the position of each booking inside the list of its attendee
+        members = [[] for _ in attendee_ids]
+        position = array('l', (0, )) * len(bookings)
+
+        for ix in range(len(bookings)):
+            position[ix] = len(members[attendee[ix]])
+            members[attendee[ix]].append(ix)
+
+        members = [array('l', m) for m in members]
+
+        def conflicts(a, b):
+            if a == b:
+                return True
+
+            oa, ob = occasion[a], occasion[b]
+
+            if group[oa] != -1 and group[oa] == group[ob]:
+                return True
+
+            if exclude[oa] or exclude[ob]:
+                return False
+
+            return intervals_overlap(intervals[oa], intervals[ob])
+
+        graph = []
+
+        for m in members:
+            g = [1 << i for i in range(len(m))]
+
+            for i in range(len(m)):
+                for j in range(i + 1, len(m)):
+                    if conflicts(m[i], m[j]):
+                        g[i] |= 1 << j
+                        g[j] |= 1 << i
+
+            graph.append(g)
+
+        limits = [
+            attendee_limits.get(aid, default_limit) for aid in attendee_ids]
+
+        # the state of each attendee, as bitsets over their bookings
+        wishlist = [(1 << len(m)) - 1 for m in members]
+        accepted = [0] * len(members)
+        blocked = [0] * len(members)
+
+        # the accepted bookings of each occasion, as a heap with the least
+        # preferred booking on top
+        taken = [[] for _ in occasions]
+
+        def available(a):
+            # see AttendeeAgent.available
+            result = conflicts = preferred = 0
+
+            for pos in range(len(members[a])):
+                if accepted[a] >> pos & 1:
+                    conflicts |= graph[a][pos]
+                    preferred += 1
+                elif limits[a] and preferred >= limits[a]:
+                    break
+                elif not conflicts >> pos & 1:
+                    result |= 1 << pos
+
+            return result
+
+        def update(a):
+            wishlist[a] = available(a)
+            blocked[a] = ((1 << len(members[a])) - 1) \
+                & ~accepted[a] & ~wishlist[a]
+
+        def displaced(ix):
+            # see AttendeeAgent.displaced
+            a, pos = attendee[ix], position[ix]
+
+            displaced = graph[a][pos] & accepted[a] & ~(1 << pos)
+            kept = accepted[a] & ~displaced
+
+            if limits[a]:
+                for _ in range(popcount(kept) + 1 - limits[a]):
+                    worst = 1 << kept.bit_length() - 1
+                    displaced |= worst
+                    kept &= ~worst
+
+            return [members[a][p] for p in bits(displaced)]
+
+        def accept(ix):
+            a, pos = attendee[ix], position[ix]
+
+            for other in displaced(ix):
+                accepted[a] &= ~(1 << position[other])
+
+            accepted[a] |= 1 << pos
+            update(a)
+
+            heappush(taken[occasion[ix]], -ix)
+
+        def deny(ix):
+            a, pos = attendee[ix], position[ix]
+
+            accepted[a] &= ~(1 << pos)
+            update(a)
+
+        def release(ix):
+            # the attendee already gave up the booking, see accept
+            taken[occasion[ix]].remove(-ix)
+            heapify(taken[occasion[ix]])
+
+        def match(ix):
+            o = occasion[ix]
+
+            # as long as there are spots, automatically accept new requests
+            if len(taken[o]) < spots[o]:
+                accept(ix)
+                return True
+
+            # if the occasion is already full, accept the booking by throwing
+            # the least preferred one out, if it has a lower score
+            if taken[o] and score[-taken[o][0]] < score[ix]:
+                deny(-heappop(taken[o]))
+                accept(ix)
+                return True
+
+            return False
+
+    stats.attendees += len(members)
+    stats.bookings += len(bookings)
+    stats.overlap_checks += sum(len(m) * (len(m) - 1) // 2 for m in members)
+
+    # see deferred_acceptance for details
+    queue = deque(a for a in reversed(range(len(members))) if wishlist[a])
+    queued = bytearray(len(members))
+
+    for a in queue:
+        queued[a] = 1
+
+    def enqueue(a):
+        if wishlist[a] and not queued[a]:
+            queue.append(a)
+            queued[a] = 1
+
+    rejected = bytearray(len(bookings))
+    budget = LoopBudget(max_ticks=len(bookings) * 2)
+
+    # the rejected bookings of each occasion, in case it is reopened
+    rejections = [[] for _ in occasions]
+
+    def reject(ix):
+        rejected[ix] = 1
+        rejections[occasion[ix]].append(ix)
+
+    def reopen(o):
+        reopened = sorted(rejections[o])
+        rejections[o] = []
+        budget.max_ticks += len(reopened)
+
+        for ix in reopened:
+            rejected[ix] = 0
+
+        for ix in reopened:
+            enqueue(attendee[ix])
+
+    with stats.phase('proposals'):
+        while queue:
+            candidate = queue.popleft()
+            queued[candidate] = 0
+            stats.turns += 1
+
+            for pos in bits(wishlist[candidate]):
+                ix = members[candidate][pos]
+
+                if rejected[ix]:
+                    continue
+
+                if budget.limit_reached(as_exception=hard_budget):
+                    queue.clear()
+                    break
+
+                stats.proposals += 1
+
+                o = occasion[ix]
+                full = len(taken[o]) >= spots[o]
+                evicted = full and taken[o] and -taken[o][0]
+                given_up = displaced(ix)
+
+                if match(ix):
+                    if full:
+                        stats.evictions += 1
+                        reject(evicted)
+                        enqueue(attendee[evicted])
+
+                    for other in given_up:
+                        stats.releases += 1
+                        release(other)
+                        reopen(occasion[other])
+
+                    enqueue(candidate)
+                    break
+
+                stats.rejections += 1
+                reject(ix)
+
+    stats.budget_ticks += budget.ticks
+
+    # make sure the algorithm didn't make any mistakes
+    if validity_check:
+        with stats.phase('validity'):
+            for a in range(len(members)):
+                for pos in bits(accepted[a]):
+                    assert not graph[a][pos] & accepted[a] & ~(1 << pos)
+
+    def lookup(states):
+        return set(
+            bookings[members[a][pos]]
+            for a, bitset in enumerate(states)
+            for pos in bits(bitset)
+        )
+
+    return Bunch(
+        open=lookup(wishlist),
+        accepted=lookup(accepted),
+        blocked=lookup(blocked)
+    )
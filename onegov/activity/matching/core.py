@@ -5,14 +5,27 @@ quadratic runtime.
 
 """
 
-from onegov.activity import Attendee, Booking, Occasion, Period
-from onegov.activity.matching.score import Scoring
-from onegov.activity.matching.utils import overlaps, LoopBudget, hashable
-from onegov.activity.matching.utils import booking_order, unblockable
+from collections import defaultdict, deque, namedtuple
+from heapq import heapify, heappop, heappush
+from onegov.activity import log
+from onegov.activity import Attendee, Booking, Occasion, OccasionSearch
+from onegov.activity import Period
+from onegov.activity.matching.compact import compact_deferred_acceptance
+from onegov.activity.matching.loader import load_bookings, load_occasions
+from onegov.activity.matching.parallel import match_components
+from onegov.activity.matching.score import Scoring, score_bookings
+from onegov.activity.matching.utils import anti_affinity_groups
+from onegov.activity.matching.utils import bits, conflict_graph
+from onegov.activity.matching.utils import LoopBudget, hashable, Inverse
+from onegov.activity.matching.utils import MatchingStats, popcount
+from onegov.activity.matching.utils import booking_order
 from onegov.core.utils import Bunch
-from itertools import groupby, product
+from itertools import groupby
+from operator import attrgetter
 from sortedcontainers import SortedSet
-from sqlalchemy.orm import joinedload, defer
+from sedate import utcnow
+from sqlalchemy import text
+from sqlalchemy.orm.attributes import set_committed_value
 
 
 class AttendeeAgent(hashable('id')):
@@ -27,53 +40,130 @@ class AttendeeAgent(hashable('id')):
 
     """
 
-    __slots__ = ('id', 'wishlist', 'accepted', 'blocked')
+    __slots__ = (
+        'id', 'limit', 'wishlist', 'accepted', 'blocked', 'bookings',
+        'index', 'conflicts', 'accepted_mask', 'blocked_mask'
+    )
 
     def __init__(self, id, bookings, limit=None, minutes_between=0,
-                 alignment=None):
+                 alignment=None, groups=None):
         self.id = id
         self.limit = limit
         self.wishlist = SortedSet(bookings, key=booking_order)
         self.accepted = set()
         self.blocked = set()
-        self.minutes_between = minutes_between
-        self.alignment = alignment
+
+        # the bookings of an attendee and their conflicts do not change
+        # during the matching, so we index them once (in the order of the
+        # wishlist) and keep the conflicts as well as the state as bitsets
+        self.bookings = tuple(self.wishlist)
+        self.index = {b: ix for ix, b in enumerate(self.bookings)}
+        self.conflicts = conflict_graph(
+            self.bookings, minutes_between, alignment,
+            with_anti_affinity_check=True, groups=groups)
+
+        self.accepted_mask = 0
+        self.blocked_mask = 0
 
     def blocks(self, subject, other):
-        return overlaps(
-            subject, other, self.minutes_between, self.alignment,
-            with_anti_affinity_check=True)
+        conflicts = self.conflicts[self.index[subject]]
+        return conflicts >> self.index[other] & 1 == 1
+
+    def available(self):
+        """ Returns the bookings the attendee may still get, as a bitset.
+
+        These are the bookings which do not conflict with any accepted
+        booking ranked above them, as long as the accepted bookings ranked
+        above them do not exhaust the limit. The accepted bookings ranked
+        below them are given up, should they be accepted (see
+        :meth:`displaced`).
+
+        """
+        available = 0
+        conflicts = 0
+        preferred = 0
+
+        for ix in range(len(self.bookings)):
+            if self.accepted_mask >> ix & 1:
+                conflicts |= self.conflicts[ix]
+                preferred += 1
+            elif self.limit and preferred >= self.limit:
+                break
+            elif not conflicts >> ix & 1:
+                available |= 1 << ix
+
+        return available
+
+    def displaced(self, booking):
+        """ Returns the accepted bookings the attendee gives up, if the given
+        booking is accepted. That is the ones conflicting with it and the
+        least preferred ones exceeding the limit.
+
+        """
+        ix = self.index[booking]
+
+        displaced = self.conflicts[ix] & self.accepted_mask & ~(1 << ix)
+        kept = self.accepted_mask & ~displaced
+
+        if self.limit:
+            for _ in range(popcount(kept) + 1 - self.limit):
+                worst = 1 << kept.bit_length() - 1
+                displaced |= worst
+                kept &= ~worst
+
+        return tuple(self.bookings[ix] for ix in bits(displaced))
+
+    def update(self):
+        """ Moves the bookings between the wishlist and the blocked bookings,
+        so that the wishlist holds the available bookings.
+
+        """
+        everything = (1 << len(self.bookings)) - 1
+        blocked = everything & ~self.available() & ~self.accepted_mask
+
+        for ix in bits(blocked & ~self.blocked_mask):
+            booking = self.bookings[ix]
+            self.wishlist.discard(booking)
+            self.blocked.add(booking)
+
+        for ix in bits(self.blocked_mask & ~blocked):
+            booking = self.bookings[ix]
+            self.blocked.remove(booking)
+            self.wishlist.add(booking)
+
+        self.blocked_mask = blocked
 
     def accept(self, booking):
-        """ Accepts the given booking. """
+        """ Accepts the given booking and gives up the displaced bookings.
+
+        The occasions of the displaced bookings are not notified, this is
+        up to the caller (see :meth:`displaced`).
+
+        """
+
+        displaced = self.displaced(booking)
 
         self.wishlist.remove(booking)
         self.accepted.add(booking)
+        self.accepted_mask |= 1 << self.index[booking]
 
-        if self.limit and len(self.accepted) >= self.limit:
-            self.blocked |= self.wishlist
-        else:
-            self.blocked |= {
-                b for b in self.wishlist if self.blocks(booking, b)
-            }
+        for other in displaced:
+            self.accepted.remove(other)
+            self.accepted_mask &= ~(1 << self.index[other])
+            self.wishlist.add(other)
 
-        self.wishlist -= self.blocked
+        self.update()
 
     def deny(self, booking):
         """ Removes the given booking from the accepted bookings. """
 
         self.wishlist.add(booking)
         self.accepted.remove(booking)
+        self.accepted_mask &= ~(1 << self.index[booking])
 
-        # remove bookings from the blocked list which are not blocked anymore
-        for booking in unblockable(
-                self.accepted, self.blocked, with_anti_affinity_check=True):
-
-            if self.limit and len(self.wishlist) >= self.limit:
-                break
-
-            self.blocked.remove(booking)
-            self.wishlist.add(booking)
+        # the bookings blocked by the denied booking become available again,
+        # even if they conflict with accepted bookings ranked below them
+        self.update()
 
     @property
     def is_valid(self):
@@ -83,8 +173,8 @@ class AttendeeAgent(hashable('id')):
         security measure to make sure there's no bug.
 
         """
-        for a, b in product(self.accepted, self.accepted):
-            if a != b and self.blocks(a, b):
+        for ix in bits(self.accepted_mask):
+            if self.conflicts[ix] & self.accepted_mask & ~(1 << ix):
                 return False
 
         return True
@@ -102,7 +192,9 @@ class OccasionAgent(hashable('id')):
 
     """
 
-    __slots__ = ('occasion', 'bookings', 'attendees', 'score_function')
+    __slots__ = (
+        'occasion', 'bookings', 'attendees', 'score_function', 'ranking'
+    )
 
     def __init__(self, occasion, score_function=None):
         self.id = occasion.id
@@ -111,36 +203,89 @@ class OccasionAgent(hashable('id')):
         self.attendees = {}
         self.score_function = score_function or (lambda b: b.score)
 
+        # the accepted bookings as a heap, with the least preferred booking
+        # on top (see :meth:`rank`)
+        self.ranking = []
+
     @property
     def full(self):
         return len(self.bookings) >= (self.occasion.max_spots)
 
+    def rank(self, booking):
+        """ Returns the heap entry of the given booking. Bookings with a
+        lower score come first, bookings with the same score are ordered
+        by :func:`booking_order` in reverse.
+
+        """
+        return (
+            self.score_function(booking),
+            Inverse(booking_order(booking)),
+            booking
+        )
+
+    @property
+    def lowest(self):
+        """ Returns the heap entry of the least preferred accepted booking,
+        or None if there are no accepted bookings.
+
+        """
+
+        # the bookings may have been changed without the use of accept/deny
+        if len(self.ranking) != len(self.bookings):
+            self.ranking = [self.rank(b) for b in self.bookings]
+            heapify(self.ranking)
+
+        return self.ranking and self.ranking[0] or None
+
+    @property
+    def threshold(self):
+        """ Returns the score a booking has to exceed to be accepted by
+        this occasion, or None if the occasion is not full.
+
+        """
+        if self.full:
+            return self.lowest and self.lowest[0]
+
     def preferred(self, booking):
-        """ Returns the first booking with a lower score than the given
-        booking (which indicates that the given booking is preferred over
-        the returned item).
+        """ Returns the booking with the lowest score, if its score is lower
+        than the score of the given booking (which indicates that the given
+        booking is preferred over the returned item).
+
+        Bookings with the same score are compared by :func:`booking_order`
+        (the last one is returned), so the result is predictable.
 
         If there's no preferred booking, None is returned.
 
         """
-        return next(
-            (
-                b for b in self.bookings
-                if self.score_function(b) < self.score_function(booking)
-            ),
-            None
-        )
+        lowest = self.lowest
+
+        if lowest and lowest[0] < self.score_function(booking):
+            return lowest[-1]
+
+        return None
 
     def accept(self, attendee, booking):
         self.attendees[booking] = attendee
         self.bookings.add(booking)
+        heappush(self.ranking, self.rank(booking))
         attendee.accept(booking)
 
     def deny(self, booking):
         self.attendees[booking].deny(booking)
+        self.release(booking)
+
+    def release(self, booking):
+        """ Removes a booking which was given up by its attendee. """
+
         self.bookings.remove(booking)
         del self.attendees[booking]
 
+        if self.ranking[0][-1] == booking:
+            heappop(self.ranking)
+        else:
+            self.ranking = [r for r in self.ranking if r[-1] != booking]
+            heapify(self.ranking)
+
     def match(self, attendee, booking):
 
         # as long as there are spots, automatically accept new requests
@@ -149,6 +294,11 @@ class OccasionAgent(hashable('id')):
 
             return True
 
+        # bookings which do not exceed the lowest score are rejected outright
+        if self.threshold is None or \
+                self.score_function(booking) <= self.threshold:
+            return False
+
         # if the occasion is already full, accept the booking by throwing
         # another one out, if there exists a better fit
         over = self.preferred(booking)
@@ -171,7 +321,10 @@ def deferred_acceptance(bookings, occasions,
                         attendee_limits=None,
                         minutes_between=0,
                         alignment=None,
-                        sort_bookings=True):
+                        sort_bookings=True,
+                        processes=1,
+                        warm_start=False,
+                        stats=None):
     """ Matches bookings with occasions.
 
     :score_function:
@@ -189,15 +342,12 @@ def deferred_acceptance(bookings, occasions,
 
     :stability_check:
         Ensures that the result does not contain any blocking pairs, that is
-        it checks that the result is stable. This runs in O(b^3) time, so
-        do not run this in production (it's more of a testing tool).
+        it checks that the result is stable. See :func:`blocking_pairs`.
 
     :hard_budget:
         Makes sure that the algorithm halts eventually by raising an exception
-        if the runtime budget of O(a*b) is reached (number of attendees
-        times the number of bookings).
-
-        Feel free to proof that this can't happen and then remove the check ;)
+        if the runtime budget of O(b) proposals is reached (each booking is
+        proposed at most twice).
 
     :default_limit:
         The maximum number of bookings which should be accepted for each
@@ -232,71 +382,203 @@ def deferred_acceptance(bookings, occasions,
         Usually you probably do not want minutes_between combined with
         an alignment.
 
+    :processes:
+        The number of processes used to match the bookings. If larger than
+        one, the bookings are split into groups of attendees which share no
+        occasions, which are then matched in parallel. The result is the
+        same. See :mod:`onegov.activity.matching.parallel`.
+
+    :warm_start:
+        Continues from the previous result, as stored in the state of the
+        bookings, instead of starting from scratch. Accepted bookings are
+        kept as long as they are still valid and open bookings which would
+        be rejected again are not proposed anymore. As a result, only the
+        changes since the last run lead to new proposals.
+
+        Attendees who may get a booking they prefer over the ones they have
+        give up the latter and propose again. Should the result still not
+        be stable (see :func:`blocking_pairs`), the matching is run from
+        scratch. The result is therefore valid and stable, but it is not
+        necessarily the same as the result of a run from scratch.
+
+    :stats:
+        A :class:`~onegov.activity.matching.utils.MatchingStats` instance,
+        which collects the time spent in each phase of the matching and
+        counts the proposals, evictions and so on. When matching in
+        multiple processes, only the time of the phases is collected.
+
     """
     assert alignment in (None, 'day')
 
+    stats = stats or MatchingStats()
+
     if sort_bookings:
         bookings = sorted(bookings, key=lambda b: b.attendee_id)
 
     attendee_limits = attendee_limits or {}
 
     # pre-calculate the booking scores
-    score_function = score_function or Scoring()
-
-    for booking in bookings:
-        booking.score = score_function(booking)
+    with stats.phase('scoring'):
+        score_bookings(bookings, score_function or Scoring())
 
     # after the booking score has been calculated, the scoring function
     # should no longer be used for performance reasons
     score_function = None
 
-    occasions = {o.id: OccasionAgent(o) for o in occasions}
+    if processes > 1:
+        with stats.phase('proposals'):
+            return match_components(
+                deferred_acceptance, bookings, occasions, processes,
+                validity_check=validity_check,
+                stability_check=stability_check,
+                hard_budget=hard_budget,
+                default_limit=default_limit,
+                attendee_limits=attendee_limits,
+                minutes_between=minutes_between,
+                alignment=alignment,
+                warm_start=warm_start
+            )
+
+    with stats.phase('setup'):
+        occasions = {o.id: OccasionAgent(o) for o in occasions}
+        groups = anti_affinity_groups(o.occasion for o in occasions.values())
+
+        attendees = {
+            aid: AttendeeAgent(
+                aid,
+                limit=attendee_limits.get(aid, default_limit),
+                bookings=bookings,
+                minutes_between=minutes_between,
+                alignment=alignment,
+                groups=groups
+            )
+            for aid, bookings in groupby(
+                bookings, key=lambda b: b.attendee_id)
+        }
 
-    attendees = {
-        aid: AttendeeAgent(
-            aid,
-            limit=attendee_limits.get(aid, default_limit),
-            bookings=bookings,
-            minutes_between=minutes_between,
-            alignment=alignment
-        )
-        for aid, bookings in groupby(bookings, key=lambda b: b.attendee_id)
-    }
+    overlap_checks = sum(
+        len(a.bookings) * (len(a.bookings) - 1) // 2
+        for a in attendees.values()
+    )
 
-    # I haven't proven yet that the following loop will always end. Until I
-    # do there's a fallback check to make sure that we'll stop at some point
-    budget = LoopBudget(max_ticks=len(bookings) * len(attendees))
+    stats.attendees += len(attendees)
+    stats.bookings += len(bookings)
+    stats.overlap_checks += overlap_checks
 
-    # while there are attendees with entries in a wishlist
-    while next((a for a in attendees.values() if a.wishlist), None):
+    # once rejected by an occasion, a booking can never be accepted by it, as
+    # a full occasion only ever trades its lowest score for a higher one -
+    # unless a spot is given up by an attendee, which reopens the occasion
+    rejected = defaultdict(set)
 
-        if budget.limit_reached(as_exception=hard_budget):
-            break
+    if warm_start:
+        with stats.phase('warm_start'):
+            warm_up(attendees, occasions, bookings, rejected)
 
-        candidates = [a for a in attendees.values() if a.wishlist]
-        matched = 0
+    def pending(attendee):
+        return any(
+            b not in rejected[b.occasion_id] for b in attendee.wishlist)
 
-        # match attendees to courses
-        while candidates:
-            candidate = candidates.pop()
+    # the attendees which may still get a booking accepted - initially this
+    # is everyone, afterwards only the attendees whose bookings were accepted
+    # (they may get another one) or denied (they may get something else)
+    queue = deque(a for a in reversed(tuple(attendees.values())) if pending(a))
+    queued = set(queue)
+
+    def enqueue(attendee):
+        if attendee.wishlist and attendee not in queued:
+            queue.append(attendee)
+            queued.add(attendee)
+
+    # as a result, each booking is proposed at most twice (once when it is
+    # accepted, once when it is rejected) - the budget is a safety net
+    budget = LoopBudget(max_ticks=len(bookings) * 2)
+
+    def reopen(occasion_id):
+        reopened = sorted(rejected.pop(occasion_id, ()), key=booking_order)
+        budget.max_ticks += len(reopened)
+
+        for booking in reopened:
+            enqueue(attendees[booking.attendee_id])
+
+    with stats.phase('proposals'):
+        while queue:
+            candidate = queue.popleft()
+            queued.remove(candidate)
+            stats.turns += 1
 
             for booking in candidate.wishlist:
-                if occasions[booking.occasion_id].match(candidate, booking):
-                    matched += 1
+                if booking in rejected[booking.occasion_id]:
+                    continue
+
+                if budget.limit_reached(as_exception=hard_budget):
+                    queue.clear()
+                    break
+
+                stats.proposals += 1
+
+                occasion = occasions[booking.occasion_id]
+                evicted = occasion.full and occasion.preferred(booking)
+                displaced = candidate.displaced(booking)
+
+                if occasion.match(candidate, booking):
+                    if evicted:
+                        stats.evictions += 1
+                        rejected[evicted.occasion_id].add(evicted)
+                        enqueue(attendees[evicted.attendee_id])
+
+                    # the spots given up may go to the rejected bookings
+                    for other in displaced:
+                        stats.releases += 1
+                        occasions[other.occasion_id].release(other)
+                        reopen(other.occasion_id)
+
+                    enqueue(candidate)
                     break  # required because the wishlist has been changed
 
-        # if no matches were possible the situation can't be improved
-        if not matched:
-            break
+                stats.rejections += 1
+                rejected[booking.occasion_id].add(booking)
+
+    stats.budget_ticks += budget.ticks
+
+    # the warm start does not guarantee a stable result in all cases, if it
+    # fails to produce one, we start from scratch
+    if warm_start:
+        with stats.phase('stability'):
+            unstable = blocking_pairs(attendees.values(), occasions.values())
+
+        if unstable:
+            # the input is counted again by the cold start, unlike the work
+            # that was done in vain
+            stats.attendees -= len(attendees)
+            stats.bookings -= len(bookings)
+            stats.overlap_checks -= overlap_checks
+
+            return deferred_acceptance(
+                bookings, [o.occasion for o in occasions.values()],
+                score_function=attrgetter('score'),
+                validity_check=validity_check,
+                stability_check=stability_check,
+                hard_budget=hard_budget,
+                default_limit=default_limit,
+                attendee_limits=attendee_limits,
+                minutes_between=minutes_between,
+                alignment=alignment,
+                sort_bookings=False,
+                stats=stats
+            )
 
     # make sure the algorithm didn't make any mistakes
     if validity_check:
-        for a in attendees.values():
-            assert a.is_valid
+        with stats.phase('validity'):
+            for a in attendees.values():
+                assert a.is_valid
+
+    # make sure the result is stable (unless we just did that)
+    if stability_check and not warm_start:
+        with stats.phase('stability'):
+            pairs = blocking_pairs(attendees.values(), occasions.values())
 
-    # make sure the result is stable
-    if stability_check:
-        assert is_stable(attendees.values(), occasions.values())
+        assert not pairs, pairs
 
     return Bunch(
         open=set(b for a in attendees.values() for b in a.wishlist),
@@ -305,26 +587,100 @@ def deferred_acceptance(bookings, occasions,
     )
 
 
-def deferred_acceptance_from_database(session, period_id, **kwargs):
+def warm_up(attendees, occasions, bookings, rejected):
+    """ Restores the previous result of the matching from the state of the
+    given bookings, for a warm start of :func:`deferred_acceptance`.
+
+    The open bookings which would be rejected right away are added to the
+    given rejected bookings, which are kept per occasion.
+
+    """
+
+    # keep the previously accepted bookings which are still valid, in
+    # the order in which they are preferred by attendees and occasions
+    for booking in sorted(bookings, key=booking_order):
+        if booking.state != 'accepted':
+            continue
+
+        attendee = attendees[booking.attendee_id]
+        occasion = occasions[booking.occasion_id]
+
+        if booking in attendee.wishlist and not occasion.full:
+            occasion.accept(attendee, booking)
+
+    # attendees who may now get a booking they prefer, give up the
+    # bookings they got in its place, so they can propose again
+    released = set()
+
+    for attendee_id, booking in blocking_pairs(
+            attendees.values(), occasions.values()):
+
+        if attendee_id in released:
+            continue
+
+        released.add(attendee_id)
+        attendee = attendees[attendee_id]
+        rank = attendee.index[booking]
+
+        for other in tuple(attendee.accepted):
+            if attendee.index[other] > rank:
+                occasions[other.occasion_id].deny(other)
+
+    # the open bookings which the occasions would reject right away
+    for b in (b for a in attendees.values() for b in a.wishlist):
+        occasion = occasions[b.occasion_id]
+
+        if occasion.full and not occasion.preferred(b):
+            rejected[b.occasion_id].add(b)
+
+
+# the arguments of the deferred acceptance which the compact variant lacks
+COMPACT_UNSUPPORTED = frozenset(('stability_check', 'processes', 'warm_start'))
+
+
+def deferred_acceptance_from_database(session, period_id, compact=False,
+                                      score_in_database=False, **kwargs):
+    """ Matches the bookings of the given period and writes the resulting
+    states to the database.
+
+    :compact:
+        Uses :func:`compact_deferred_acceptance` instead of
+        :func:`deferred_acceptance`, which yields the same result using a
+        fraction of the memory. It does not support the ``stability_check``,
+        ``processes`` and ``warm_start`` arguments, passing them raises a
+        :class:`TypeError`.
+
+    :score_in_database:
+        Evaluates the scoring in the database, writing the scores of the
+        period with a single statement (see :meth:`Scoring.update_scores`).
+        The matching then uses those scores, instead of calculating them.
+
+    All other keyword arguments are passed to the matching function. The
+    time spent loading and writing the bookings is added to the ``stats``,
+    which are logged at the end.
+
+    """
+    if compact:
+        unsupported = COMPACT_UNSUPPORTED.intersection(kwargs)
+
+        if unsupported:
+            raise TypeError("Not supported by the compact matching: {}".format(
+                ', '.join(sorted(unsupported))))
+
+    stats = kwargs.setdefault('stats', MatchingStats())
+
     period = session.query(Period).filter(Period.id == period_id).one()
 
-    b = session.query(Booking)
-    b = b.options(joinedload(Booking.occasion))
-    b = b.filter(Booking.period_id == period_id)
-    b = b.filter(Booking.state != 'cancelled')
-    b = b.filter(Booking.created >= period.created)
-    b = b.order_by(Booking.attendee_id)
-
-    o = session.query(Occasion)
-    o = o.filter(Occasion.period_id == period_id)
-    o = o.options(
-        defer('meeting_point'),
-        defer('note'),
-        defer('cost')
-    )
+    if score_in_database:
+        with stats.phase('database_scoring'):
+            scoring = kwargs.pop('score_function', None) or Scoring()
+            scoring.update_scores(session, period_id)
+            kwargs['score_function'] = attrgetter('score')
 
-    if period.all_inclusive and period.max_bookings_per_attendee:
-        default_limit = period.max_bookings_per_attendee
+    settings = period.settings
+
+    if settings.booking_limit:
+        default_limit = settings.booking_limit
         attendee_limits = None
     else:
         default_limit = None
@@ -333,30 +689,164 @@ def deferred_acceptance_from_database(session, period_id, **kwargs):
             session.query(Attendee.id, Attendee.limit)
         }
 
-    # fetch it here as it'll be reused multiple times
-    bookings = list(b)
+    # only load what is needed by the matching and the scoring
+    with stats.phase('loading'):
+        occasions = load_occasions(session, period_id)
+        bookings = load_bookings(session, period, occasions)
+
+    match = compact and compact_deferred_acceptance or deferred_acceptance
 
-    results = deferred_acceptance(
-        bookings=bookings, occasions=o,
+    results = match(
+        bookings=bookings, occasions=occasions,
         default_limit=default_limit, attendee_limits=attendee_limits,
-        minutes_between=period.minutes_between, alignment=period.alignment,
+        minutes_between=settings.minutes_between,
+        alignment=settings.alignment,
         sort_bookings=False, **kwargs)
 
-    # write the changes to the database
-    def update_bookings(targets, state):
-        q = session.query(Booking)
-        q = q.filter(Booking.state != state)
-        q = q.filter(Booking.state != 'cancelled')
-        q = q.filter(Booking.period_id == period_id)
-        q = q.filter(Booking.id.in_(t.id for t in targets))
+    with stats.phase('writing'):
+        update_bookings(session, period_id, (
+            (booking, state)
+            for state in ('open', 'accepted', 'blocked')
+            for booking in getattr(results, state)
+        ))
+
+    log.info(f"Matched period {period_id}: {stats}")
+
+
+def update_bookings(session, period_id, changes):
+    """ Writes the given (booking, state) pairs to the database, together
+    with the score of each booking.
+
+    This is done using a single statement (plus one to update the
+    aggregated attendee count of the occasions), instead of one statement
+    per booking. Bookings loaded in the session are updated in memory as
+    well, without being marked as modified.
+
+    """
+    ids, states, scores = [], [], []
+
+    for booking, state in changes:
+        ids.append(str(booking.id))
+        states.append(state)
+        scores.append(booking.score)
+
+    if not ids:
+        return
+
+    results = {
+        booking_id: (state, score)
+        for booking_id, state, score in zip(ids, states, scores)
+    }
+
+    session.execute(text("""
+        UPDATE bookings
+           SET state = results.state,
+               score = results.score,
+               modified = :modified
+          FROM (
+            SELECT
+                UNNEST(CAST(:ids AS UUID[])) AS id,
+                UNNEST(CAST(:states AS booking_state[])) AS state,
+                UNNEST(CAST(:scores AS NUMERIC[])) AS score
+          ) AS results
+         WHERE bookings.id = results.id
+           AND bookings.period_id = :period_id
+           AND bookings.state != 'cancelled'
+           AND (
+                bookings.state != results.state
+                OR bookings.score != results.score
+           )
+    """), {
+        'ids': ids,
+        'states': states,
+        'scores': scores,
+        'modified': utcnow(),
+        'period_id': period_id
+    })
+
+    # the attendee count is an aggregate which is only kept up to date
+    # by the ORM, so we have to do this ourselves
+    session.execute(text("""
+        UPDATE occasions
+           SET attendee_count = (
+                SELECT COUNT(*)
+                  FROM bookings
+                 WHERE bookings.occasion_id = occasions.id
+                   AND bookings.state = 'accepted'
+           )
+         WHERE occasions.period_id = :period_id
+    """), {'period_id': period_id})
+
+    # the search entries depend on the attendee count as well
+    OccasionSearch.refresh(session, period_ids=(period_id, ))
+
+    for key, obj in session.identity_map.items():
+        if isinstance(obj, Booking):
+            result = results.get(str(key[1][0]))
+
+            if result:
+                set_committed_value(obj, 'state', result[0])
+                set_committed_value(obj, 'score', result[1])
+
+        elif isinstance(obj, Occasion):
+            session.expire(obj, ['attendee_count'])
+
+
+BlockingPair = namedtuple('BlockingPair', ('attendee_id', 'booking'))
+
+
+def blocking_pairs(attendees, occasions):
+    """ Returns the blocking pairs of the matching between the given
+    attendee and occasion agents. If there are none, the matching is stable.
+
+    A blocking pair is an attendee and a booking which was not accepted,
+    where both sides would rather have the booking than what they have:
+
+    * The occasion has spots left or scores the booking higher than its
+      least preferred accepted booking.
+
+    * The booking does not conflict with any of the accepted bookings the
+      attendee prefers over it, and those do not exhaust the attendee's
+      limit either.
+
+    This runs in O(b) time, where b is the number of bookings, so it is
+    cheap enough to be run in production.
+
+    """
+
+    def wanted(occasion, booking):
+        if not occasion.full:
+            return True
+
+        threshold = occasion.threshold
+        return threshold is not None \
+            and threshold < occasion.score_function(booking)
+
+    occasions = {o.id: o for o in occasions}
+    pairs = []
+
+    for attendee in attendees:
+
+        # the bookings of the attendee are indexed by their rank
+        conflicts = 0
+        preferred = 0
+
+        for ix, booking in enumerate(attendee.bookings):
+            if attendee.accepted_mask >> ix & 1:
+                conflicts |= attendee.conflicts[ix]
+                preferred += 1
+                continue
+
+            if conflicts >> ix & 1:
+                continue
+
+            if attendee.limit and preferred >= attendee.limit:
+                break
 
-        for booking in q:
-            booking.state = state
+            if wanted(occasions[booking.occasion_id], booking):
+                pairs.append(BlockingPair(attendee.id, booking))
 
-    with session.no_autoflush:
-        update_bookings(results.open, 'open')
-        update_bookings(results.accepted, 'accepted')
-        update_bookings(results.blocked, 'blocked')
+    return pairs
 
 
 def is_stable(attendees, occasions):
@@ -365,7 +855,7 @@ def is_stable(attendees, occasions):
 
     This runs in O(n^4) time, where n is the combination of
     bookings and occasions. So this is a testing tool, not something to
-    run in production.
+    run in production. See :func:`blocking_pairs` for a check that is.
 
     """
 
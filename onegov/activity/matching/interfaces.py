@@ -9,6 +9,8 @@ class MatchableOccasion(metaclass=ABCMeta):
 
     """
 
+    __slots__ = ()
+
     @property
     @abstractmethod
     def id(self):
@@ -49,6 +51,8 @@ class MatchableBooking(metaclass=ABCMeta):
 
     """
 
+    __slots__ = ()
+
     def __eq__(self, other):
         """ The class must be comparable to other classes. """
 
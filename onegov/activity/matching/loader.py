@@ -0,0 +1,180 @@
+""" Loads the input of the matching from the database, without the overhead
+of the ORM.
+
+Only the columns used by the matching and the scoring are fetched, using
+one query for the bookings, one for the occasions and one for the dates.
+The results are turned into lightweight implementations of
+:class:`MatchableBooking` and :class:`MatchableOccasion`.
+
+"""
+
+import sedate
+
+from collections import namedtuple
+from onegov.activity.matching.interfaces import MatchableBooking
+from onegov.activity.matching.interfaces import MatchableOccasion
+from onegov.activity.models import Booking, Occasion, OccasionDate
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+
+DateRange = namedtuple('DateRange', ('start', 'end'))
+
+
+class OccasionRecord(MatchableOccasion):
+
+    __slots__ = (
+        'id', 'max_spots', 'exclude_from_overlap_check', 'activity_id',
+        'period_id', 'dates', '_intervals'
+    )
+
+    def __init__(self, id, max_spots, exclude_from_overlap_check,
+                 activity_id, period_id, dates=()):
+        self.id = id
+        self.max_spots = max_spots
+        self.exclude_from_overlap_check = exclude_from_overlap_check
+        self.activity_id = activity_id
+        self.period_id = period_id
+        self.dates = dates
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    @property
+    def anti_affinity_group(self):
+        """ See :attr:`onegov.activity.models.Occasion.anti_affinity_group`.
+
+        """
+        return (self.activity_id.hex, self.period_id.hex)
+
+
+class BookingRecord(MatchableBooking):
+
+    __slots__ = (
+        'id', 'attendee_id', 'occasion_id', 'period_id', 'priority',
+        'group_code', 'username', 'state', 'score', 'occasion'
+    )
+
+    def __init__(self, id, attendee_id, occasion_id, period_id, priority,
+                 group_code, username, state, score, occasion):
+        self.id = id
+        self.attendee_id = attendee_id
+        self.occasion_id = occasion_id
+        self.period_id = period_id
+        self.priority = priority
+        self.group_code = group_code
+        self.username = username
+        self.state = state
+        self.score = score
+        self.occasion = occasion
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    @property
+    def dates(self):
+        return self.occasion.dates
+
+
+def load_dates(session, period_id):
+    """ Returns the date ranges of all occasions in the given period, keyed
+    by occasion id.
+
+    """
+
+    q = session.query(OccasionDate)
+    q = q.join(Occasion)
+    q = q.filter(Occasion.period_id == period_id)
+    q = q.group_by(OccasionDate.occasion_id)
+    q = q.with_entities(
+        OccasionDate.occasion_id,
+        func.array_agg(aggregate_order_by(
+            OccasionDate.start, OccasionDate.start)),
+        func.array_agg(aggregate_order_by(
+            OccasionDate.end, OccasionDate.start)),
+    )
+
+    # the dates are stored as naive UTC datetimes
+    def utc(dt):
+        return sedate.replace_timezone(dt, 'UTC')
+
+    return {
+        occasion_id: tuple(
+            DateRange(utc(s), utc(e)) for s, e in zip(starts, ends)
+        )
+        for occasion_id, starts, ends in q
+    }
+
+
+def load_occasions(session, period_id):
+    """ Returns the occasions of the given period as records. """
+
+    dates = load_dates(session, period_id)
+
+    q = session.query(Occasion)
+    q = q.filter(Occasion.period_id == period_id)
+    q = q.with_entities(
+        Occasion.id,
+        func.upper(Occasion.spots) - 1,
+        Occasion.exclude_from_overlap_check,
+        Occasion.activity_id,
+    )
+
+    return [
+        OccasionRecord(
+            id=id,
+            max_spots=max_spots,
+            exclude_from_overlap_check=exclude_from_overlap_check,
+            activity_id=activity_id,
+            period_id=period_id,
+            dates=dates.get(id, ())
+        )
+        for id, max_spots, exclude_from_overlap_check, activity_id in q
+    ]
+
+
+def load_bookings(session, period, occasions):
+    """ Returns the bookings of the given period which take part in the
+    matching as records, ordered by attendee.
+
+    """
+
+    occasions = {o.id: o for o in occasions}
+
+    q = session.query(Booking)
+    q = q.filter(Booking.period_id == period.id)
+    q = q.filter(Booking.state != 'cancelled')
+    q = q.filter(Booking.created >= period.created)
+    q = q.order_by(Booking.attendee_id)
+    q = q.with_entities(
+        Booking.id,
+        Booking.attendee_id,
+        Booking.occasion_id,
+        Booking.priority,
+        Booking.group_code,
+        Booking.username,
+        Booking.state,
+        Booking.score,
+    )
+
+    return [
+        BookingRecord(
+            id=r.id,
+            attendee_id=r.attendee_id,
+            occasion_id=r.occasion_id,
+            period_id=period.id,
+            priority=r.priority,
+            group_code=r.group_code,
+            username=r.username,
+            state=r.state,
+            score=r.score,
+            occasion=occasions[r.occasion_id]
+        )
+        for r in q
+    ]
@@ -0,0 +1,206 @@
+""" Splits the matching into independent parts, which are matched in
+separate processes.
+
+Attendees only interact with each other through the occasions they share.
+Each connected component of the graph between attendees and occasions may
+therefore be matched on its own, with the same result as if all bookings
+were matched together.
+
+As the bookings and occasions given to the matching are usually bound to
+the database, they are sent to the worker processes as lightweight
+snapshots, carrying the pre-calculated scores.
+
+"""
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from onegov.activity.matching.interfaces import MatchableBooking
+from onegov.activity.matching.interfaces import MatchableOccasion
+from onegov.activity.matching.loader import DateRange
+from onegov.core.utils import Bunch
+
+
+class OccasionSnapshot(MatchableOccasion):
+
+    __slots__ = (
+        'id', 'max_spots', 'exclude_from_overlap_check',
+        'anti_affinity_group', 'dates', '_intervals'
+    )
+
+    def __init__(self, occasion, dates):
+        self.id = occasion.id
+        self.max_spots = occasion.max_spots
+        self.exclude_from_overlap_check = occasion.exclude_from_overlap_check
+        self.anti_affinity_group = occasion.anti_affinity_group
+        self.dates = dates
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+
+class BookingSnapshot(MatchableBooking):
+
+    __slots__ = (
+        'id', 'attendee_id', 'occasion_id', 'priority', 'group_code',
+        'state', 'score', 'occasion', 'dates'
+    )
+
+    def __init__(self, booking, occasion, dates):
+        self.id = booking.id
+        self.attendee_id = booking.attendee_id
+        self.occasion_id = booking.occasion_id
+        self.priority = booking.priority
+        self.group_code = booking.group_code
+        self.state = booking.state
+        self.score = booking.score
+        self.occasion = occasion
+        self.dates = dates
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+
+def components(bookings):
+    """ Splits the given bookings into the connected components of the graph
+    between attendees and occasions.
+
+    Returns a list of lists of bookings. The bookings of each component keep
+    the order in which they were given, as do the components themselves
+    (by their first booking).
+
+    """
+
+    # union-find over the occasions, each attendee joins the occasions
+    # of its bookings
+    parent = {}
+
+    def find(occasion_id):
+        root = occasion_id
+
+        while parent[root] != root:
+            root = parent[root]
+
+        while parent[occasion_id] != root:
+            parent[occasion_id], occasion_id = root, parent[occasion_id]
+
+        return root
+
+    first = {}
+
+    for booking in bookings:
+        parent.setdefault(booking.occasion_id, booking.occasion_id)
+
+        if booking.attendee_id not in first:
+            first[booking.attendee_id] = booking.occasion_id
+        else:
+            a = find(first[booking.attendee_id])
+            b = find(booking.occasion_id)
+
+            if a != b:
+                parent[b] = a
+
+    parts = defaultdict(list)
+
+    for booking in bookings:
+        parts[find(booking.occasion_id)].append(booking)
+
+    return list(parts.values())
+
+
+def precomputed_score(booking):
+    return booking.score
+
+
+def match_component(match, bookings, occasions, options):
+    """ Matches a single component inside a worker process, returning the ids
+    of the open, accepted and blocked bookings.
+
+    """
+
+    result = match(
+        bookings, occasions,
+        score_function=precomputed_score,
+        sort_bookings=False,
+        **options
+    )
+
+    return tuple(
+        [b.id for b in getattr(result, state)]
+        for state in ('open', 'accepted', 'blocked')
+    )
+
+
+def match_components(match, bookings, occasions, processes,
+                     attendee_limits=None, **options):
+    """ Matches each component of the given bookings in a pool of the given
+    number of processes, using the given matching function, and merges the
+    results.
+
+    The bookings are expected to be scored and sorted by attendee. The
+    matching function has to be importable by the worker processes.
+
+    """
+
+    occasions = {o.id: o for o in occasions}
+    attendee_limits = attendee_limits or {}
+
+    by_id = {}
+    jobs = []
+
+    # bookings of the same occasion share their dates
+    dates = {}
+
+    for part in components(bookings):
+        snapshots = {}
+        part_bookings = []
+
+        for booking in part:
+            if booking.occasion_id not in snapshots:
+                occasion_dates = tuple(
+                    DateRange(d.start, d.end) for d in booking.dates)
+                occasion_dates = dates.setdefault(
+                    occasion_dates, occasion_dates)
+
+                snapshots[booking.occasion_id] = OccasionSnapshot(
+                    occasions[booking.occasion_id], occasion_dates)
+
+            snapshot = snapshots[booking.occasion_id]
+
+            part_bookings.append(
+                BookingSnapshot(booking, snapshot, snapshot.dates))
+
+            by_id[booking.id] = booking
+
+        part_limits = {
+            b.attendee_id: attendee_limits[b.attendee_id]
+            for b in part if b.attendee_id in attendee_limits
+        }
+
+        jobs.append((
+            part_bookings,
+            list(snapshots.values()),
+            dict(options, attendee_limits=part_limits)
+        ))
+
+    result = Bunch(open=set(), accepted=set(), blocked=set())
+
+    # the largest components are submitted first, as they take the longest
+    jobs.sort(key=lambda job: len(job[0]), reverse=True)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(match_component, match, *job) for job in jobs
+        ]
+
+        for future in futures:
+            for state, ids in zip(('open', 'accepted', 'blocked'),
+                                  future.result()):
+                getattr(result, state).update(by_id[i] for i in ids)
+
+    return result
@@ -2,7 +2,41 @@ import hashlib
 
 from onegov.activity.models import Activity, Attendee, Booking, Occasion
 from onegov.user import User
-from sqlalchemy import func
+from sqlalchemy import and_, case, func, literal, select, update
+from sqlalchemy.orm import aliased
+
+
+def per_key(bookings, key, function):
+    """ Calls the given function with the first booking of each distinct key
+    and returns the results for all bookings, in order.
+
+    """
+    cache = {}
+    results = []
+
+    for booking in bookings:
+        k = key(booking)
+
+        if k not in cache:
+            cache[k] = function(booking)
+
+        results.append(cache[k])
+
+    return results
+
+
+def score_bookings(bookings, score_function):
+    """ Stores the score of each booking on the booking, using the batch
+    method of the score function if available.
+
+    """
+    if hasattr(score_function, 'batch'):
+        scores = score_function.batch(bookings)
+    else:
+        scores = (score_function(b) for b in bookings)
+
+    for booking, score in zip(bookings, scores):
+        booking.score = score
 
 
 class Scoring(object):
@@ -11,6 +45,12 @@ class Scoring(object):
     A criteria is a callable which takes a booking and returns a score.
     The final score is the sum of all criteria scores.
 
+    Criteria may additionally offer a ``batch`` method, which takes a list
+    of bookings and returns a list of scores. See :meth:`batch`.
+
+    Criteria which offer an ``expression`` method may also be evaluated by
+    the database. See :meth:`update_scores`.
+
     """
 
     def __init__(self, criteria=None):
@@ -19,6 +59,64 @@ class Scoring(object):
     def __call__(self, booking):
         return sum(criterium(booking) for criterium in self.criteria)
 
+    def batch(self, bookings):
+        """ Returns the scores of the given bookings, in order.
+
+        The result is the same as calling the scoring for each booking, but
+        each criterion is evaluated for all bookings at once, which allows
+        it to compute its lookups once per occasion, attendee or group,
+        instead of once per booking.
+
+        """
+        bookings = tuple(bookings)
+
+        columns = [
+            criterium.batch(bookings) if hasattr(criterium, 'batch')
+            else [criterium(b) for b in bookings]
+            for criterium in self.criteria
+        ]
+
+        return [sum(scores) for scores in zip(*columns)]
+
+    def expression(self, session, period_id):
+        """ Returns the sum of all criteria as SQL expression.
+
+        The expression is evaluated per booking, with the occasion and the
+        attendee of the booking joined.
+
+        """
+        return sum(
+            criterium.expression(session, period_id)
+            for criterium in self.criteria
+        )
+
+    def update_scores(self, session, period_id):
+        """ Writes the score of all bookings of the given period (except for
+        cancelled ones) with a single UPDATE statement.
+
+        The criteria are evaluated by the database instead of in Python,
+        which is considerably faster for large periods. The bookings loaded
+        into the session are expired, so they reflect the new scores.
+
+        """
+        # the statement has to see the pending changes of the session
+        session.flush()
+
+        session.execute(
+            update(Booking.__table__)
+            .values(score=self.expression(session, period_id))
+            .where(and_(
+                Booking.occasion_id == Occasion.id,
+                Booking.attendee_id == Attendee.id,
+                Booking.period_id == period_id,
+                Booking.state != 'cancelled'
+            ))
+        )
+
+        for obj in session.identity_map.values():
+            if isinstance(obj, Booking):
+                session.expire(obj, ('score', ))
+
     @classmethod
     def from_settings(cls, settings, session):
         scoring = cls()
@@ -71,6 +169,12 @@ class PreferMotivated(object):
     def __call__(self, booking):
         return booking.priority
 
+    def batch(self, bookings):
+        return [b.priority for b in bookings]
+
+    def expression(self, session, period_id):
+        return Booking.priority
+
 
 class PreferInAgeBracket(object):
     """ Scores bookings whose attendees fall into the age-bracket of the
@@ -109,15 +213,37 @@ class PreferInAgeBracket(object):
 
             if attendees is None:
                 attendees = {a.id: a.age for a in session.query(
-                    Attendee.id, Attendee.age)}
+                    Attendee.id, Attendee.age)
+                    .filter(Attendee.id.in_(
+                        session.query(Booking.attendee_id)
+                        .filter(Booking.period_id == booking.period_id)
+                        .subquery()
+                    ))}
 
             return attendees[booking.attendee_id]
 
         return cls(get_age_range, get_attendee_age)
 
     def __call__(self, booking):
-        min_age, max_age = self.get_age_range(booking)
-        attendee_age = self.get_attendee_age(booking)
+        return self.score(
+            self.get_age_range(booking),
+            self.get_attendee_age(booking))
+
+    def batch(self, bookings):
+        age_ranges = per_key(
+            bookings, lambda b: b.occasion_id, self.get_age_range)
+
+        attendee_ages = per_key(
+            bookings, lambda b: b.attendee_id, self.get_attendee_age)
+
+        return [
+            self.score(age_range, attendee_age)
+            for age_range, attendee_age in zip(age_ranges, attendee_ages)
+        ]
+
+    @staticmethod
+    def score(age_range, attendee_age):
+        min_age, max_age = age_range
 
         if min_age <= attendee_age and attendee_age <= max_age:
             return 1.0
@@ -128,6 +254,21 @@ class PreferInAgeBracket(object):
             )
             return 1.0 - min(1.0, difference / 10.0)
 
+    def expression(self, session, period_id):
+        min_age = func.lower(Occasion.age)
+        max_age = func.upper(Occasion.age) - 1
+        attendee_age = Attendee.age
+
+        difference = func.least(
+            func.abs(min_age - attendee_age),
+            func.abs(max_age - attendee_age)
+        )
+
+        return case(
+            [(and_(min_age <= attendee_age, attendee_age <= max_age), 1.0)],
+            else_=1.0 - func.least(1.0, difference / 10.0)
+        )
+
 
 class PreferOrganiserChildren(object):
     """ Scores bookings of children higher if their parents are organisers.
@@ -166,6 +307,25 @@ class PreferOrganiserChildren(object):
     def __call__(self, booking):
         return self.get_is_organiser_child(booking) and 1.0 or 0.0
 
+    def batch(self, bookings):
+        return [
+            is_organiser_child and 1.0 or 0.0
+            for is_organiser_child in per_key(
+                bookings, lambda b: b.username, self.get_is_organiser_child)
+        ]
+
+    def expression(self, session, period_id):
+        # the occasion of the booking is part of the statement, so the
+        # occasions of the organisers need to be looked up separately
+        occasion = aliased(Occasion)
+
+        organisers = select([Activity.username]).where(and_(
+            Activity.id == occasion.activity_id,
+            occasion.period_id == period_id
+        ))
+
+        return case([(Booking.username.in_(organisers), 1.0)], else_=0.0)
+
 
 class PreferAdminChildren(object):
     """ Scores bookings of children higher if their parents are admins. """
@@ -194,6 +354,21 @@ class PreferAdminChildren(object):
     def __call__(self, booking):
         return self.get_is_association_child(booking) and 1.0 or 0.0
 
+    def batch(self, bookings):
+        return [
+            is_association_child and 1.0 or 0.0
+            for is_association_child in per_key(
+                bookings, lambda b: b.username, self.get_is_association_child)
+        ]
+
+    def expression(self, session, period_id):
+        members = select([User.username]).where(and_(
+            User.role == 'admin',
+            User.active == True
+        ))
+
+        return case([(Booking.username.in_(members), 1.0)], else_=0.0)
+
 
 class PreferGroups(object):
     """ Scores group bookings higher than other bookings. Groups get a boost
@@ -213,49 +388,91 @@ class PreferGroups(object):
     groups generally do not have the same score. So an occasion will generally
     prefer the members of one group over members of another group.
 
+    Note that the scoring created through :meth:`from_session` does not
+    apply this extra boost (see ``boost_unprioritised``).
+
     """
 
-    def __init__(self, get_group_score):
+    def __init__(self, get_group_score, boost_unprioritised=True):
         self.get_group_score = get_group_score
+        self.boost_unprioritised = boost_unprioritised
+
+    @staticmethod
+    def unique_score_modifier(group_code):
+        digest = hashlib.sha1(group_code.encode('utf-8')).hexdigest()[:8]
+        number = int(digest, 16)
+
+        return float('0.0' + str(number)[:8])
+
+    @classmethod
+    def group_scores(cls, session, period_id):
+        """ Returns the score of each group in the given period. """
+
+        query = session.query(Booking).with_entities(
+            Booking.group_code,
+            func.count(Booking.group_code).label('count')
+        ).filter(
+            Booking.group_code != None,
+            Booking.period_id == period_id
+        ).group_by(
+            Booking.group_code
+        ).having(
+            func.count(Booking.group_code) > 1
+        )
+
+        return {
+            r.group_code:
+            max(.5, 1.0 - 0.2 * (r.count - 2))
+            + cls.unique_score_modifier(r.group_code)
+
+            for r in query
+        }
 
     @classmethod
     def from_session(cls, session):
         group_scores = None
 
-        def unique_score_modifier(group_code):
-            digest = hashlib.sha1(group_code.encode('utf-8')).hexdigest()[:8]
-            number = int(digest, 16)
-
-            return float('0.0' + str(number)[:8])
-
         def get_group_score(booking):
             nonlocal group_scores
 
             if group_scores is None:
-                query = session.query(Booking).with_entities(
-                    Booking.group_code,
-                    func.count(Booking.group_code).label('count')
-                ).filter(
-                    Booking.group_code != None,
-                    Booking.period_id == booking.period_id
-                ).group_by(
-                    Booking.group_code
-                ).having(
-                    func.count(Booking.group_code) > 1
-                )
-
-                group_scores = {
-                    r.group_code:
-                    max(.5, 1.0 - 0.2 * (r.count - 2))
-                    + unique_score_modifier(r.group_code)
-
-                    for r in query
-                }
+                group_scores = cls.group_scores(session, booking.period_id)
 
             return group_scores.get(booking.group_code, 0)
 
-        return get_group_score
+        # historically, the scoring only used the group score, without the
+        # boost of unprioritised bookings - this is kept for consistency
+        return cls(get_group_score, boost_unprioritised=False)
+
+    def offset(self, booking):
+        if self.boost_unprioritised:
+            return 0 if booking.priority else 1
+
+        return 0
 
     def __call__(self, booking):
-        offset = 0 if booking.priority else 1
-        return self.get_group_score(booking) + offset
+        return self.get_group_score(booking) + self.offset(booking)
+
+    def batch(self, bookings):
+        group_scores = per_key(
+            bookings, lambda b: b.group_code, self.get_group_score)
+
+        return [
+            group_score + self.offset(booking)
+            for booking, group_score in zip(bookings, group_scores)
+        ]
+
+    def expression(self, session, period_id):
+        # the unique modifier is not available in SQL, so the group scores
+        # are calculated upfront and passed to the database
+        group_scores = self.group_scores(session, period_id)
+
+        if group_scores:
+            score = case(group_scores, value=Booking.group_code, else_=0.0)
+        else:
+            score = literal(0.0)
+
+        if self.boost_unprioritised:
+            score = score + case([(Booking.priority == 0, 1)], else_=0)
+
+        return score
@@ -1,43 +1,98 @@
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
 from onegov.activity import log
-from onegov.activity.utils import dates_overlap
+from itertools import accumulate, combinations
+from onegov.activity.utils import booking_overlaps as overlaps
+from onegov.activity.utils import occasion_intervals
+from onegov.activity.utils import padded_intervals
 from sortedcontainers import SortedSet
+from time import perf_counter
 
 
-def overlaps(booking, other, minutes_between=0, alignment=None,
-             with_anti_affinity_check=False):
-    """ Returns true if the given booking overlaps with the given booking
-    or occasion.
+def anti_affinity_groups(occasions):
+    """ Interns the anti-affinity groups of the given occasions, returning
+    a dictionary of occasion ids to integer group ids (or None, for
+    occasions without an anti-affinity group).
 
     """
 
-    # even if exclude_from_overlap_check is active we consider a booking
-    # to overlap itself (this protects against double bookings)
-    if booking.id == other.id:
-        return True
+    interned = {}
 
-    if hasattr(other, 'occasion'):
-        other_occasion = other.occasion
-    else:
-        other_occasion = other
+    return {
+        o.id: None if group is None else interned.setdefault(
+            group, len(interned))
+        for o in occasions
+        for group in (o.anti_affinity_group, )
+    }
 
-    if with_anti_affinity_check:
-        if other_occasion.anti_affinity_group is not None:
-            if booking.occasion.anti_affinity_group \
-                    == other_occasion.anti_affinity_group:
-                return True
-
-    if booking.occasion.exclude_from_overlap_check:
-        return False
-
-    if other_occasion.exclude_from_overlap_check:
-        return False
-
-    return dates_overlap(
-        tuple((b.start, b.end) for b in booking.dates),
-        tuple((o.start, o.end) for o in other.dates),
-        minutes_between=minutes_between,
-        alignment=alignment
-    )
+
+def conflict_graph(bookings, minutes_between=0, alignment=None,
+                   with_anti_affinity_check=False, groups=None):
+    """ Returns the conflicts between the given bookings as a list of
+    bitsets, one for each booking in the given order.
+
+    The nth bit of the ith bitset is set if the ith booking overlaps with
+    the nth booking. As bookings overlap themselves, the ith bit is always
+    set as well.
+
+    This is meant to be computed once for the bookings of a single
+    attendee, so that further overlap checks amount to a bitwise and.
+
+    If the anti-affinity groups of the occasions have been interned with
+    :func:`anti_affinity_groups`, they may be passed as well. The bookings
+    are then bucketed by group, instead of comparing the groups of each
+    pair of bookings.
+
+    """
+
+    bookings = tuple(bookings)
+    graph = [1 << ix for ix in range(len(bookings))]
+
+    if with_anti_affinity_check and groups is not None:
+        siblings = {}
+
+        for ix, booking in enumerate(bookings):
+            group = groups[booking.occasion_id]
+
+            if group is not None:
+                siblings[group] = siblings.get(group, 0) | 1 << ix
+
+        for ix, booking in enumerate(bookings):
+            group = groups[booking.occasion_id]
+
+            if group is not None:
+                graph[ix] |= siblings[group]
+
+        with_anti_affinity_check = False
+
+    for i, j in combinations(range(len(bookings)), 2):
+        if graph[i] >> j & 1:
+            continue
+
+        if overlaps(bookings[i], bookings[j], minutes_between, alignment,
+                    with_anti_affinity_check=with_anti_affinity_check):
+            graph[i] |= 1 << j
+            graph[j] |= 1 << i
+
+    return graph
+
+
+def bits(bitset):
+    """ Yields the indices of the bits set in the given bitset, from the
+    lowest to the highest.
+
+    """
+
+    while bitset:
+        lowest = bitset & -bitset
+        yield lowest.bit_length() - 1
+        bitset ^= lowest
+
+
+def popcount(bitset):
+    """ Returns the number of bits set in the given bitset. """
+
+    return bin(bitset).count('1')
 
 
 class LoopBudget(object):
@@ -70,6 +125,73 @@ class LoopBudget(object):
         self.ticks += 1
 
 
+class MatchingStats(object):
+    """ Collects the wall time spent in each phase of a matching run, as
+    well as a number of counters. For example::
+
+        stats = MatchingStats()
+        deferred_acceptance(bookings, occasions, stats=stats)
+
+        log.info(f"Matching done: {stats}")
+
+    To report the phases elsewhere (e.g. to a metrics system), override
+    :meth:`report`, which is called at the end of each phase.
+
+    The turns count how many times an attendee was taken from the queue to
+    propose. As attendees are queued again whenever they get a booking or
+    lose one, there are no rounds in which every attendee proposes once.
+
+    """
+
+    counters = (
+        'attendees',
+        'bookings',
+        'turns',
+        'proposals',
+        'evictions',
+        'releases',
+        'rejections',
+        'overlap_checks',
+        'budget_ticks',
+    )
+
+    def __init__(self):
+        self.phases = {}
+
+        for counter in self.counters:
+            setattr(self, counter, 0)
+
+    @contextmanager
+    def phase(self, name):
+        """ Measures the wall time of the given phase. If a phase is
+        entered multiple times, the durations are summed up.
+
+        """
+        start = perf_counter()
+
+        try:
+            yield
+        finally:
+            duration = perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0) + duration
+            self.report(name, duration)
+
+    def report(self, phase, duration):
+        pass
+
+    def as_dict(self):
+        return {
+            'phases': dict(self.phases),
+            **{counter: getattr(self, counter) for counter in self.counters}
+        }
+
+    def __str__(self):
+        return ', '.join((
+            *('{}: {:.3f}s'.format(k, v) for k, v in self.phases.items()),
+            *('{}: {}'.format(c, getattr(self, c)) for c in self.counters)
+        ))
+
+
 def hashable(attribute):
 
     class Hashable(object):
@@ -83,6 +205,24 @@ def hashable(attribute):
     return Hashable
 
 
+class Inverse(object):
+    """ Wraps a value, inverting its order in comparisons. Useful to sort
+    or heap by multiple keys in opposing directions.
+
+    """
+
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
 def booking_order(booking):
     """ Keeps the bookings predictably sorted from highest to lowest priority.
 
@@ -91,19 +231,109 @@ def booking_order(booking):
     return booking.score * - 1, booking.priority * -1, booking.id
 
 
+class IntervalIndex(object):
+    """ Indexes the given intervals (see
+    :func:`onegov.activity.utils.padded_intervals`), to find out if other
+    intervals overlap with any of them in O(log n).
+
+    The result is the same as with
+    :func:`onegov.activity.utils.intervals_overlap`.
+
+    """
+
+    def __init__(self, intervals):
+        intervals = tuple(intervals)
+        proper = sorted(i for i in intervals if i[0] <= i[1])
+
+        # the starts of the intervals and the highest end up to each start
+        self.starts = [s for s, e in proper]
+        self.ends = list(accumulate((e for s, e in proper), max))
+
+        # inverted intervals are points, which do not overlap each other
+        self.points = sorted(s for s, e in intervals if e < s)
+
+    def overlaps(self, intervals):
+        return any(self.overlaps_interval(s, e) for s, e in intervals)
+
+    def overlaps_interval(self, start, end):
+        point = end < start
+
+        if point:
+            end = start
+
+        ix = bisect_right(self.starts, end)
+
+        if ix and self.ends[ix - 1] >= start:
+            return True
+
+        if point:
+            return False
+
+        return bisect_left(self.points, start) < bisect_right(self.points, end)
+
+
 def unblockable(
-        accepted, blocked, key=booking_order, with_anti_affinity_check=False):
+        accepted, blocked, key=booking_order, with_anti_affinity_check=False,
+        settings=None):
     """ Returns a set of items in the blocked set which do not block
     with anything. The set is ordered using :func:`booking_order`.
 
+    Instead of comparing each blocked booking with each accepted booking,
+    the dates of the accepted bookings are indexed, which takes
+    O((a + b) log(a + b)) time. The result is the same as if the bookings
+    were compared using :func:`overlaps`.
+
+    The settings of the period the bookings belong to should be passed,
+    otherwise they are looked up through the first accepted booking.
+
     """
 
-    unblockable = SortedSet(blocked, key=key)
+    accepted = tuple(accepted)
+
+    # the bookings of an attendee all belong to the same period
+    if settings is None:
+        period = accepted and getattr(accepted[0], 'period', None)
+        settings = period and period.settings
+
+    if settings:
+        minutes_between = settings.minutes_between
+        alignment = settings.alignment
+    else:
+        minutes_between, alignment = 0, None
+
+    def excluded(booking):
+        occasion = booking.occasion
+        return occasion is not None and occasion.exclude_from_overlap_check
+
+    def intervals(booking):
+        if booking.occasion is not None:
+            return occasion_intervals(
+                booking.occasion, minutes_between, alignment)
+
+        return padded_intervals(
+            ((d.start, d.end) for d in booking.dates),
+            minutes_between, alignment)
+
+    ids = {a.id for a in accepted}
+    index = IntervalIndex(
+        i for a in accepted if not excluded(a) for i in intervals(a))
+
+    if with_anti_affinity_check:
+        groups = {a.occasion.anti_affinity_group for a in accepted}
+        groups.discard(None)
+    else:
+        groups = ()
+
+    def blocks(booking):
+        if booking.id in ids:
+            return True
+
+        if groups and booking.occasion.anti_affinity_group in groups:
+            return True
+
+        if excluded(booking):
+            return False
 
-    for a in accepted:
-        for b in blocked:
-            if a.overlaps(
-                    b, with_anti_affinity_check=with_anti_affinity_check):
-                unblockable.discard(b)
+        return index.overlaps(intervals(booking))
 
-    return unblockable
+    return SortedSet((b for b in blocked if not blocks(b)), key=key)
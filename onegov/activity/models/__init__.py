@@ -7,7 +7,9 @@ from onegov.activity.models.invoice_reference import InvoiceReference
 from onegov.activity.models.occasion import Occasion
 from onegov.activity.models.occasion_date import OccasionDate, DAYS
 from onegov.activity.models.occasion_need import OccasionNeed
-from onegov.activity.models.period import Period
+from onegov.activity.models.occasion_search import OccasionSearch
+from onegov.activity.models.period import Period, PeriodPhase
+from onegov.activity.models.period import PeriodSettings, PeriodSnapshot
 from onegov.activity.models.publication_request import PublicationRequest
 
 __all__ = [
@@ -20,7 +22,11 @@ __all__ = [
     'Occasion',
     'OccasionDate',
     'OccasionNeed',
+    'OccasionSearch',
     'Period',
+    'PeriodPhase',
+    'PeriodSettings',
+    'PeriodSnapshot',
     'PublicationRequest',
     'ACTIVITY_STATES',
     'DAYS'
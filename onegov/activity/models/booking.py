@@ -1,4 +1,5 @@
 from onegov.activity.models.occasion import Occasion
+from onegov.activity.utils import booking_overlaps
 from onegov.core.orm import Base
 from onegov.core.orm.mixins import TimestampMixin
 from onegov.core.orm.types import UUID
@@ -226,13 +227,21 @@ class Booking(Base, TimestampMixin):
     def order(self):
         return self.occasion.order
 
-    def overlaps(self, other, with_anti_affinity_check=False):
-        # XXX circular import
-        from onegov.activity.matching import utils
+    def overlaps(self, other, with_anti_affinity_check=False, settings=None):
+        """ Returns true if this booking overlaps with the given booking or
+        occasion.
 
-        return utils.overlaps(
+        When comparing many bookings, pass the settings of the period (see
+        :attr:`onegov.activity.models.Period.settings`), or use
+        :func:`onegov.activity.utils.booking_overlaps` directly.
+
+        """
+
+        settings = settings or self.period.settings
+
+        return booking_overlaps(
             self, other,
-            minutes_between=self.period.minutes_between,
-            alignment=self.period.alignment,
+            minutes_between=settings.minutes_between,
+            alignment=settings.alignment,
             with_anti_affinity_check=with_anti_affinity_check,
         )
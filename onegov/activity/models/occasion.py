@@ -4,10 +4,11 @@ from datetime import timedelta
 from onegov.core.orm import Base
 from onegov.core.orm.mixins import TimestampMixin
 from onegov.core.orm.types import UUID
-from onegov.activity.models.occasion_date import DAYS
+from onegov.activity.models.occasion_date import DAYS, OccasionDate
 from psycopg2.extras import NumericRange
 from sqlalchemy import Boolean
 from sqlalchemy import case
+from sqlalchemy import event
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import func
@@ -17,6 +18,7 @@ from sqlalchemy import Text
 from sqlalchemy.dialects.postgresql import ARRAY, INT4RANGE
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, object_session, validates
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy_utils import aggregated, observes
 from uuid import uuid4
 
@@ -123,6 +125,10 @@ class Occasion(Base, TimestampMixin):
         backref='occasion',
     )
 
+    #: The dates as integer intervals, memoised per period settings by
+    #: :func:`onegov.activity.utils.occasion_intervals`
+    _intervals = None
+
     def on_date_change(self):
         """ Date changes are not properly propagated to the observer for
         some reason, so we do this manually with a hook.
@@ -176,6 +182,7 @@ class Occasion(Base, TimestampMixin):
 
     @observes('dates')
     def observe_dates(self, dates):
+        self._intervals = None
         self.duration = self.compute_duration(dates)
         self.order = self.compute_order(dates)
         self.weekdays = self.compute_weekdays(dates)
@@ -183,6 +190,8 @@ class Occasion(Base, TimestampMixin):
 
     @validates('dates')
     def validate_dates(self, key, date):
+        self._intervals = None
+
         for o in self.dates:
             if o.id != date.id:
                 assert not sedate.overlaps(
@@ -264,30 +273,52 @@ class Occasion(Base, TimestampMixin):
         assert not self.cancelled
         period = self.period
 
-        if not period.confirmed:
-            def cancel(booking):
-                booking.state = 'cancelled'
-        else:
-            bookings = BookingCollection(object_session(self))
-            scoring = period.scoring
-
-            def cancel(booking):
-                bookings.cancel_booking(booking, scoring)
-
         for booking in self.bookings:
             assert booking.period_id == period.id
-            cancel(booking)
 
+        # the occasion is cancelled first, so the spots freed by the
+        # cancelled bookings are not given to waiting bookings
         self.cancelled = True
 
+        if not period.confirmed:
+            for booking in self.bookings:
+                booking.state = 'cancelled'
+        else:
+            # the cascade of all bookings is computed at once
+            BookingCollection(object_session(self)).cancel_bookings(
+                self.bookings, period.scoring)
+
     def is_too_young(self, birth_date):
-        return self.period.age_barrier.is_too_young(
+        return self.period.settings.age_barrier.is_too_young(
             birth_date=birth_date,
             start_date=self.dates[0].start.date(),
             min_age=self.age.lower)
 
     def is_too_old(self, birth_date):
-        return self.period.age_barrier.is_too_old(
+        return self.period.settings.age_barrier.is_too_old(
             birth_date=birth_date,
             start_date=self.dates[0].start.date(),
             max_age=self.age.upper - 1)
+
+
+@event.listens_for(Occasion, 'expire')
+@event.listens_for(Occasion, 'refresh')
+def reset_intervals(occasion, *args):
+    occasion._intervals = None
+
+
+# the memoised intervals are outdated as soon as a date changes, not only
+# once the change is flushed - the occasion of the date is not necessarily
+# loaded through the date, but it has to be loaded to hold any intervals
+@event.listens_for(OccasionDate.start, 'set')
+@event.listens_for(OccasionDate.end, 'set')
+def reset_date_intervals(date, *args):
+    occasion = date.__dict__.get('occasion')
+    session = object_session(date)
+
+    if occasion is None and session and date.occasion_id:
+        occasion = session.identity_map.get(
+            identity_key(Occasion, date.occasion_id))
+
+    if occasion is not None:
+        occasion._intervals = None
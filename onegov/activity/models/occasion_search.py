@@ -0,0 +1,240 @@
+from onegov.activity.models.booking import Booking
+from onegov.activity.models.occasion import Occasion
+from onegov.activity.models.occasion_date import OccasionDate
+from onegov.activity.models.period import Period
+from onegov.core.orm import Base
+from onegov.core.orm.types import UUID
+from sqlalchemy import case, exists, func, or_, select
+from sqlalchemy import Column
+from sqlalchemy import event
+from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import Integer
+from sqlalchemy import inspect
+from sqlalchemy import Numeric
+from sqlalchemy import Text
+from sqlalchemy.dialects.postgresql import ARRAY, INT4RANGE
+from sqlalchemy.orm import object_session
+
+
+class OccasionSearch(Base):
+    """ A denormalised copy of the occasion values used to filter
+    activities (see :class:`onegov.activity.ActivityCollection`).
+
+    Each dated occasion has exactly one entry, which holds the values of
+    the occasion, its period and its bookings that would otherwise have
+    to be joined. The entries are refreshed whenever those values change
+    through the ORM. Changes made through plain SQL statements require a
+    call to :meth:`refresh`.
+
+    """
+
+    __tablename__ = 'occasion_search'
+
+    #: The occasion of the entry
+    occasion_id = Column(
+        UUID, ForeignKey('occasions.id', ondelete='CASCADE'),
+        primary_key=True)
+
+    #: The activity of the occasion
+    activity_id = Column(
+        UUID, ForeignKey('activities.id', ondelete='CASCADE'),
+        nullable=False)
+
+    #: The period of the occasion
+    period_id = Column(
+        UUID, ForeignKey('periods.id', ondelete='CASCADE'), nullable=False)
+
+    #: The price of the occasion, including the booking cost of the period
+    price = Column(Numeric(precision=9, scale=2), nullable=False)
+
+    #: The expected age of participants
+    age = Column(INT4RANGE, nullable=False)
+
+    #: Days on which the occasion is active (see :attr:`Occasion.active_days`)
+    active_days = Column(ARRAY(Integer), nullable=False)
+
+    #: Weekdays on which the occasion is active
+    weekdays = Column(ARRAY(Integer), nullable=False)
+
+    #: The duration of the occasion (see :class:`DAYS`)
+    duration = Column(Integer, nullable=True)
+
+    #: The availability of spots ('none', 'few' or 'many'), NULL if the
+    #: occasion is overbooked
+    availability = Column(Text, nullable=True)
+
+    __table_args__ = (
+        Index('occasion_search_by_activity', 'activity_id'),
+        Index('occasion_search_by_period', 'period_id'),
+        Index('occasion_search_by_price', 'price'),
+        Index('occasion_search_by_age', 'age', postgresql_using='gist'),
+        Index(
+            'occasion_search_by_active_days', 'active_days',
+            postgresql_using='gin'),
+        Index(
+            'occasion_search_by_weekdays', 'weekdays',
+            postgresql_using='gin'),
+    )
+
+    @classmethod
+    def refresh(cls, session, occasion_ids=None, period_ids=None):
+        """ Rebuilds the entries of the given occasions as well as the
+        entries of all occasions of the given periods.
+
+        If neither occasions nor periods are given, all entries are
+        rebuilt.
+
+        """
+
+        table = cls.__table__
+        rebuild_all = occasion_ids is None and period_ids is None
+
+        conditions = []
+        entries = []
+
+        if occasion_ids:
+            conditions.append(Occasion.id.in_(occasion_ids))
+            entries.append(table.c.occasion_id.in_(occasion_ids))
+
+        if period_ids:
+            conditions.append(Occasion.period_id.in_(period_ids))
+            entries.append(table.c.period_id.in_(period_ids))
+
+        if rebuild_all:
+            session.execute(table.delete())
+        elif conditions:
+            session.execute(table.delete().where(or_(*entries)))
+        else:
+            return
+
+        available_spots = Occasion.available_spots
+
+        query = select([
+            Occasion.id,
+            Occasion.activity_id,
+            Occasion.period_id,
+            func.coalesce(Occasion.cost, 0)
+            + func.coalesce(Period.occasion_extra_cost, 0),
+            Occasion.age,
+            Occasion.active_days,
+            Occasion.weekdays,
+            Occasion.duration,
+            case([
+                (available_spots == 0, 'none'),
+                (available_spots.in_((1, 2, 3)), 'few'),
+                (available_spots >= 4, 'many'),
+            ])
+        ])
+
+        query = query.select_from(
+            Occasion.__table__.join(
+                Period.__table__, Occasion.period_id == Period.id))
+
+        # occasions without dates are never found by the filters
+        query = query.where(
+            exists().where(OccasionDate.occasion_id == Occasion.id))
+
+        if conditions:
+            query = query.where(or_(*conditions))
+
+        session.execute(table.insert().from_select((
+            'occasion_id',
+            'activity_id',
+            'period_id',
+            'price',
+            'age',
+            'active_days',
+            'weekdays',
+            'duration',
+            'availability',
+        ), query))
+
+
+#: The attributes of the objects which are copied to the search entries
+SEARCH_ATTRIBUTES = {
+    Occasion: (
+        'activity_id', 'period_id', 'cost', 'age', 'spots', 'cancelled',
+        'active_days', 'weekdays', 'duration'
+    ),
+    OccasionDate: ('occasion_id', 'start', 'end', 'timezone'),
+    Booking: ('occasion_id', 'state'),
+    Period: ('booking_cost', 'all_inclusive'),
+}
+
+
+def has_changes(obj, *attributes):
+    state = inspect(obj)
+
+    return any(state.attrs[a].history.has_changes() for a in attributes)
+
+
+def loaded_value(obj, attribute):
+    # the objects may have been deleted in the meantime, so we only use
+    # the values we already know
+    return inspect(obj).dict.get(attribute)
+
+
+def remember(obj):
+    """ Remembers the given object, whose changes affect the search entries,
+    until the end of the flush.
+
+    The entries are refreshed by a listener registered on the session of
+    the object, so sessions which do not use the search entries are not
+    affected.
+
+    """
+
+    session = object_session(obj)
+    session.info.setdefault('occasion_search', set()).add(obj)
+
+    if not event.contains(session, 'after_flush_postexec', refresh_entries):
+        event.listen(session, 'after_flush_postexec', refresh_entries)
+
+
+def on_insert_or_delete(mapper, connection, target):
+    remember(target)
+
+
+def on_update(mapper, connection, target):
+    # subclasses share the attributes of the mapped base class
+    if has_changes(target, *SEARCH_ATTRIBUTES[mapper.base_mapper.class_]):
+        remember(target)
+
+
+for cls in SEARCH_ATTRIBUTES:
+    event.listen(cls, 'after_insert', on_insert_or_delete, propagate=True)
+    event.listen(cls, 'after_update', on_update, propagate=True)
+    event.listen(cls, 'after_delete', on_insert_or_delete, propagate=True)
+
+
+def refresh_entries(session, context):
+    """ Refreshes the search entries of the objects which were changed
+    during the flush.
+
+    The attendee counts of the occasions are updated in 'after_flush', so
+    they are up to date at this point.
+
+    """
+
+    changed = session.info.pop('occasion_search', None)
+
+    if not changed:
+        return
+
+    occasion_ids = set()
+    period_ids = set()
+
+    for obj in changed:
+        if isinstance(obj, Occasion):
+            occasion_ids.add(loaded_value(obj, 'id'))
+        elif isinstance(obj, Period):
+            period_ids.add(loaded_value(obj, 'id'))
+        else:
+            occasion_ids.add(loaded_value(obj, 'occasion_id'))
+
+    occasion_ids.discard(None)
+    period_ids.discard(None)
+
+    if occasion_ids or period_ids:
+        OccasionSearch.refresh(session, occasion_ids, period_ids)
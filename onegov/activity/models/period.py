@@ -1,5 +1,6 @@
 import sedate
 
+from collections import namedtuple
 from datetime import date, datetime
 from onegov.activity.models.age_barrier import AgeBarrier
 from onegov.activity.models.booking import Booking
@@ -8,7 +9,7 @@ from onegov.core.orm import Base
 from onegov.core.orm.mixins import TimestampMixin
 from onegov.core.orm.types import UUID, JSON
 from sqlalchemy import Boolean
-from sqlalchemy import case, desc, not_, distinct, func
+from sqlalchemy import and_, case, not_, or_, func, update
 from sqlalchemy import CheckConstraint
 from sqlalchemy import column
 from sqlalchemy import Column
@@ -17,12 +18,104 @@ from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import Numeric
 from sqlalchemy import Text
+from sqlalchemy import event
+from sqlalchemy import inspect
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import object_session, relationship, joinedload, defer
 from sqlalchemy.orm import validates
 from uuid import uuid4
 
 
+class PeriodSettings(namedtuple('PeriodSettings', (
+        'minutes_between', 'alignment', 'booking_limit', 'all_inclusive',
+        'age_barrier'))):
+    """ An immutable snapshot of the period settings used when booking.
+
+    Reading the settings from the snapshot does not touch the period, so
+    it may be passed around freely in loops over many bookings.
+
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_period(cls, period):
+        return cls(
+            minutes_between=period.minutes_between or 0,
+            alignment=period.alignment or None,
+            booking_limit=period.booking_limit or None,
+            all_inclusive=period.all_inclusive,
+            age_barrier=period.age_barrier
+        )
+
+
+class PeriodPhase(namedtuple('PeriodPhase', (
+        'day', 'phase', 'today', 'prebooking_start', 'prebooking_end',
+        'execution_start', 'execution_end'))):
+    """ An immutable snapshot of the phase of a period on a given day,
+    together with the boundaries of the phases as local datetimes.
+
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_period(cls, period, day):
+        local = period.as_local_datetime
+
+        def boundary(value):
+            return value and local(value)
+
+        today = local(day)
+        prebooking_start = boundary(period.prebooking_start)
+        execution_start = boundary(period.execution_start)
+        execution_end = boundary(period.execution_end)
+
+        if not period.active or today < prebooking_start:
+            phase = 'inactive'
+        elif not period.confirmed:
+            phase = 'wishlist'
+        elif not period.finalized:
+            phase = 'booking'
+        elif today < execution_start:
+            phase = 'payment'
+        elif execution_start <= today <= execution_end:
+            phase = 'execution'
+        elif today > execution_end:
+            phase = 'archive'
+        else:
+            phase = None
+
+        return cls(
+            day=day,
+            phase=phase,
+            today=today,
+            prebooking_start=prebooking_start,
+            prebooking_end=boundary(period.prebooking_end),
+            execution_start=execution_start,
+            execution_end=execution_end
+        )
+
+
+class PeriodSnapshot(namedtuple('PeriodSnapshot', (
+        'id', 'title', 'settings', 'phase'))):
+    """ An immutable snapshot of a period, with its settings and its phase
+    on a given day (see :class:`PeriodSettings` and :class:`PeriodPhase`).
+
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_period(cls, period):
+        return cls(
+            id=period.id,
+            title=period.title,
+            settings=period.settings,
+            phase=period.phase_snapshot
+        )
+
+
 class Period(Base, TimestampMixin):
 
     __tablename__ = 'periods'
@@ -146,11 +239,61 @@ class Period(Base, TimestampMixin):
             ))
         ])
 
+    #: The cached settings of the period (see :attr:`settings`)
+    _settings = None
+
     @validates('age_barrier_type')
     def validate_age_barrier_type(self, key, age_barrier_type):
         assert age_barrier_type in AgeBarrier.registry
+        self._settings = None
         return age_barrier_type
 
+    @validates(
+        'minutes_between', 'alignment', 'max_bookings_per_attendee',
+        'all_inclusive')
+    def validate_settings(self, key, value):
+        self._settings = None
+        return value
+
+    @property
+    def settings(self):
+        """ Returns the settings of the period as :class:`PeriodSettings`.
+
+        The settings are cached until they are changed or the period is
+        expired/refreshed.
+
+        """
+        if self._settings is None:
+            self._settings = PeriodSettings.from_period(self)
+
+        return self._settings
+
+    #: The cached phase of the period (see :attr:`phase_snapshot`)
+    _phase = None
+
+    @validates(
+        'active', 'confirmed', 'finalized', 'prebooking_start',
+        'prebooking_end', 'execution_start', 'execution_end')
+    def validate_phase(self, key, value):
+        self._phase = None
+        return value
+
+    @property
+    def phase_snapshot(self):
+        """ Returns the phase of the period today as :class:`PeriodPhase`.
+
+        The snapshot is cached for the rest of the day, or until the dates
+        or flags of the period are changed or the period is
+        expired/refreshed.
+
+        """
+        day = date.today()
+
+        if self._phase is None or self._phase.day != day:
+            self._phase = PeriodPhase.from_period(self, day)
+
+        return self._phase
+
     @property
     def age_barrier(self):
         return AgeBarrier.from_name(self.age_barrier_type)
@@ -190,11 +333,58 @@ class Period(Base, TimestampMixin):
 
         self.active = False
 
-    def confirm(self):
-        """ Confirms the current period. """
+    def confirm(self, set_based=True):
+        """ Confirms the current period.
+
+        Open bookings are marked as denied and the booking costs are copied
+        over permanently (so they can't change anymore). This is done using
+        two UPDATE statements. If ``set_based`` is False, the bookings are
+        loaded and changed one by one instead.
+
+        """
 
         self.confirmed = True
 
+        if not set_based:
+            self.confirm_bookings()
+            return
+
+        session = object_session(self)
+
+        # the statements have to see the pending changes of the session
+        session.flush()
+
+        session.execute(
+            update(Booking.__table__)
+            .values(state='denied')
+            .where(and_(
+                Booking.period_id == self.id,
+                Booking.state == 'open'
+            ))
+        )
+
+        session.execute(
+            update(Booking.__table__)
+            .values(cost=(
+                func.coalesce(Occasion.cost, 0) + Period.occasion_extra_cost
+            ))
+            .where(and_(
+                Booking.occasion_id == Occasion.id,
+                Booking.period_id == Period.id,
+                Booking.period_id == self.id
+            ))
+        )
+
+        for obj in session.identity_map.values():
+            if isinstance(obj, Booking):
+                session.expire(obj, ('state', 'cost', 'modified'))
+
+    def confirm_bookings(self):
+        """ Marks the open bookings as denied and copies the booking costs
+        using the ORM. See :meth:`confirm`.
+
+        """
+
         # open bookings are marked as denied during completion
         # and the booking costs are copied over permanently (so they can't
         # change anymore)
@@ -217,7 +407,18 @@ class Period(Base, TimestampMixin):
     def archive(self):
         """ Moves all accepted activities with an occasion in this period
         into the archived state, unless there's already another occasion
-        in a period newer than the current period.
+        in a period newer than the current period. Periods which start at
+        the same time as the current period count as newer.
+
+        Activities without any occasion are archived as well. Returns the
+        number of archived activities.
+
+        The activities are archived using a single UPDATE statement, which
+        bypasses :meth:`Activity.archive` and the ORM events. The archived
+        activities in the session are expired instead. Activities whose
+        class overrides :meth:`Activity.archive` are archived through the
+        ORM, as are all of them if the session manager has receivers for
+        updated objects (e.g. the search index).
 
         """
         assert self.confirmed and self.finalized
@@ -227,47 +428,75 @@ class Period(Base, TimestampMixin):
 
         session = object_session(self)
 
-        def future_periods():
-            p = session.query(Period)
-            p = p.order_by(desc(Period.execution_start))
-            p = p.with_entities(Period.id)
-
-            for period in p:
-                if period.id == self.id:
-                    break
-                yield period.id
+        # XXX circular import
+        from onegov.activity.models.activity import Activity
 
-        # get the activities which have an occasion in a future period
-        f = session.query(Occasion)
-        f = f.with_entities(Occasion.activity_id)
-        f = f.filter(Occasion.period_id.in_(tuple(future_periods())))
+        # the statement has to see the pending changes of the session
+        session.flush()
 
-        # get the activities which have an occasion in the given period but
-        # no occasion in any future period
-        o = session.query(Occasion)
-        o = o.filter(Occasion.period_id == self.id)
-        o = o.filter(not_(Occasion.activity_id.in_(f.subquery())))
-        o = o.options(joinedload(Occasion.activity))
+        # the periods newer than the given period
+        future_periods = session.query(Period.id)
+        future_periods = future_periods.filter(
+            Period.execution_start >= self.execution_start)
+        future_periods = future_periods.filter(Period.id != self.id)
 
-        # archive those
-        for occasion in o:
-            if occasion.activity.state == 'accepted':
-                occasion.activity.archive()
+        # the activities which have an occasion in a future period
+        f = session.query(Occasion.activity_id)
+        f = f.filter(Occasion.period_id.in_(future_periods.subquery()))
 
-        # also archive all activities without an occasion
-        w = session.query(Occasion)
-        w = w.with_entities(distinct(Occasion.activity_id))
+        # the activities which have an occasion in the given period
+        o = session.query(Occasion.activity_id)
+        o = o.filter(Occasion.period_id == self.id)
 
-        # XXX circular import
-        from onegov.activity.models.activity import Activity
+        # the activities which have an occasion at all
+        w = session.query(Occasion.activity_id)
 
         a = session.query(Activity)
-        a = a.filter(not_(Activity.id.in_(w.subquery())))
         a = a.filter(Activity.state == 'accepted')
-
-        for activity in a:
+        a = a.filter(or_(
+            and_(
+                Activity.id.in_(o.subquery()),
+                not_(Activity.id.in_(f.subquery()))
+            ),
+            not_(Activity.id.in_(w.subquery()))
+        ))
+
+        manager = self.session_manager
+
+        if manager and manager.on_update.receivers:
+            custom = None
+        else:
+            custom = {
+                m.polymorphic_identity
+                for m in inspect(Activity).self_and_descendants
+                if m.class_.archive is not Activity.archive
+            }
+
+        if custom is None:
+            archived = a.all()
+            count = 0
+        else:
+            if custom:
+                archived = a.filter(Activity.type.in_(custom)).all()
+                a = a.filter(or_(
+                    Activity.type == None,
+                    not_(Activity.type.in_(custom))
+                ))
+            else:
+                archived = ()
+
+            count = a.update(
+                {Activity.state: 'archived'}, synchronize_session=False)
+
+            for obj in session.identity_map.values():
+                if isinstance(obj, Activity):
+                    session.expire(obj, ('state', 'modified'))
+
+        for activity in archived:
             activity.archive()
 
+        return count + len(archived)
+
     @property
     def booking_limit(self):
         """ Returns the max_bookings_per_attendee limit if it applies. """
@@ -281,26 +510,7 @@ class Period(Base, TimestampMixin):
 
     @property
     def phase(self):
-        local = self.as_local_datetime
-        today = local(date.today())
-
-        if not self.active or today < local(self.prebooking_start):
-            return 'inactive'
-
-        if not self.confirmed:
-            return 'wishlist'
-
-        if not self.finalized:
-            return 'booking'
-
-        if today < local(self.execution_start):
-            return 'payment'
-
-        if local(self.execution_start) <= today <= local(self.execution_end):
-            return 'execution'
-
-        if today > local(self.execution_end):
-            return 'archive'
+        return self.phase_snapshot.phase
 
     @property
     def wishlist_phase(self):
@@ -324,32 +534,30 @@ class Period(Base, TimestampMixin):
 
     @property
     def is_prebooking_in_future(self):
-        today = self.as_local_datetime(date.today())
-        start = self.as_local_datetime(self.prebooking_start)
+        snapshot = self.phase_snapshot
 
-        return today < start
+        return snapshot.today < snapshot.prebooking_start
 
     @property
     def is_currently_prebooking(self):
-        if not self.wishlist_phase:
+        snapshot = self.phase_snapshot
+
+        if snapshot.phase != 'wishlist':
             return False
 
-        today = self.as_local_datetime(date.today())
-        start = self.as_local_datetime(self.prebooking_start)
-        end = self.as_local_datetime(self.prebooking_end)
+        start, end = snapshot.prebooking_start, snapshot.prebooking_end
 
-        return start <= today <= end
+        return start <= snapshot.today <= end
 
     @property
     def is_prebooking_in_past(self):
-        today = self.as_local_datetime(date.today())
-        start = self.as_local_datetime(self.prebooking_start)
-        end = self.as_local_datetime(self.prebooking_end)
+        snapshot = self.phase_snapshot
+        start, end = snapshot.prebooking_start, snapshot.prebooking_end
 
-        if today > end:
+        if snapshot.today > end:
             return True
 
-        return start <= today and not self.wishlist_phase
+        return start <= snapshot.today and snapshot.phase != 'wishlist'
 
     @property
     def scoring(self):
@@ -363,3 +571,10 @@ class Period(Base, TimestampMixin):
     @scoring.setter
     def scoring(self, scoring):
         self.data['match-settings'] = scoring.settings
+
+
+@event.listens_for(Period, 'expire')
+@event.listens_for(Period, 'refresh')
+def reset_settings(period, *args):
+    period._settings = None
+    period._phase = None
@@ -1,4 +1,5 @@
 import random
+import pytest
 
 from datetime import date, timedelta
 from functools import partial
@@ -8,6 +9,7 @@ from onegov.activity.matching import PreferGroups
 from onegov.activity.matching import PreferInAgeBracket
 from onegov.activity.matching import PreferOrganiserChildren
 from onegov.activity.matching import Scoring
+from onegov.activity.matching.loader import load_bookings, load_occasions
 from onegov.core.utils import Bunch
 from psycopg2.extras import NumericRange
 from uuid import uuid4
@@ -424,3 +426,199 @@ def test_prefer_groups_equal(session, owner, collections, prebooking_period):
     assert b2.state == 'accepted'
     assert b3.state == 'blocked'
     assert b4.state == 'blocked'
+
+
+def test_compact_match(session, owner, collections, prebooking_period):
+    o1 = new_occasion(collections, prebooking_period, 0, 1, spots=(0, 1))
+    o2 = new_occasion(collections, prebooking_period, 1, 1, spots=(0, 2))
+    o3 = new_occasion(collections, prebooking_period, 3, 1, spots=(0, 1))
+
+    a1 = new_attendee(collections, user=owner)
+    a2 = new_attendee(collections, user=owner)
+    a3 = new_attendee(collections, user=owner)
+
+    bookings = [
+        collections.bookings.add(owner, a1, o1, priority=1),
+        collections.bookings.add(owner, a1, o2, priority=0),
+        collections.bookings.add(owner, a2, o1, priority=0),
+        collections.bookings.add(owner, a2, o3, priority=1),
+        collections.bookings.add(owner, a3, o2, priority=0),
+        collections.bookings.add(owner, a3, o3, priority=0),
+    ]
+
+    match(session, prebooking_period.id)
+    expected = [b.state for b in bookings]
+
+    for booking in bookings:
+        booking.state = 'open'
+
+    deferred_acceptance_from_database(
+        session, prebooking_period.id, compact=True)
+
+    assert [b.state for b in bookings] == expected
+
+    # the options of the original implementation are rejected up front
+    for option in ('stability_check', 'processes', 'warm_start'):
+        with pytest.raises(TypeError) as e:
+            deferred_acceptance_from_database(
+                session, prebooking_period.id, compact=True, **{option: 1})
+
+        assert option in str(e.value)
+
+
+def test_match_writes_states_and_scores(session, owner, collections,
+                                        prebooking_period):
+    o = new_occasion(collections, prebooking_period, 0, 1, spots=(0, 1))
+
+    a1 = new_attendee(collections)
+    a2 = new_attendee(collections)
+
+    b1 = collections.bookings.add(owner, a1, o, priority=1)
+    b2 = collections.bookings.add(owner, a2, o, priority=0)
+
+    match(session, prebooking_period.id)
+
+    assert b1.state == 'accepted'
+    assert b2.state == 'open'
+    assert o.attendee_count == 1
+    assert not session.is_modified(b1)
+    assert not session.is_modified(b2)
+
+    session.expire_all()
+
+    assert b1.state == 'accepted'
+    assert b2.state == 'open'
+    assert b1.score == 1
+    assert b2.score == 0
+    assert o.attendee_count == 1
+
+
+def test_load_records(session, owner, collections, prebooking_period):
+    o = new_occasion(collections, prebooking_period, 0, 1, spots=(0, 4))
+    collections.occasions.add_date(
+        o,
+        o.dates[0].end + timedelta(days=2),
+        o.dates[0].end + timedelta(days=3),
+        o.dates[0].timezone
+    )
+
+    a = new_attendee(collections, user=owner)
+    b = collections.bookings.add(owner, a, o, priority=1)
+    b.group_code = 'foo'
+
+    occasions = load_occasions(session, prebooking_period.id)
+    bookings = load_bookings(session, prebooking_period, occasions)
+
+    assert len(occasions) == 1
+    assert occasions[0].id == o.id
+    assert occasions[0].max_spots == 4
+    assert occasions[0].anti_affinity_group == o.anti_affinity_group
+    assert not occasions[0].exclude_from_overlap_check
+    assert occasions[0].dates == tuple(
+        (d.start, d.end) for d in o.dates
+    )
+
+    assert len(bookings) == 1
+    assert bookings[0] == b
+    assert bookings[0].occasion is occasions[0]
+    assert bookings[0].attendee_id == a.id
+    assert bookings[0].period_id == prebooking_period.id
+    assert bookings[0].priority == 1
+    assert bookings[0].group_code == 'foo'
+    assert bookings[0].username == owner.username
+    assert bookings[0].dates == occasions[0].dates
+
+    # the records do not carry an instance dictionary
+    assert not hasattr(occasions[0], '__dict__')
+    assert not hasattr(bookings[0], '__dict__')
+
+
+def test_score_in_database(session, owner, member, collections,
+                           prebooking_period):
+
+    owner.role = 'admin'
+
+    o1 = new_occasion(collections, prebooking_period, 0, 1, spots=(0, 1),
+                      age=(10, 20), username=owner.username)
+    o2 = new_occasion(collections, prebooking_period, 2, 1, spots=(0, 1),
+                      age=(5, 8), username=owner.username)
+
+    base = prebooking_period.prebooking_start.date()
+
+    a1 = new_attendee(collections, user=owner,
+                      birth_date=base - timedelta(days=365 * 12))
+    a2 = new_attendee(collections, user=member,
+                      birth_date=base - timedelta(days=365 * 25))
+    a3 = new_attendee(collections, user=member,
+                      birth_date=base - timedelta(days=365 * 9))
+
+    bookings = [
+        collections.bookings.add(owner, a1, o1, priority=1),
+        collections.bookings.add(member, a2, o1),
+        collections.bookings.add(member, a3, o1),
+        collections.bookings.add(owner, a1, o2),
+        collections.bookings.add(member, a2, o2, priority=1),
+        collections.bookings.add(member, a3, o2),
+    ]
+
+    for booking in bookings[1:3]:
+        booking.group_code = 'foo'
+
+    session.flush()
+
+    scoring = Scoring(criteria=[
+        PreferInAgeBracket.from_session(session),
+        PreferOrganiserChildren.from_session(session),
+        PreferAdminChildren.from_session(session),
+        PreferGroups.from_session(session),
+    ])
+    scoring.criteria.append(PreferGroups(
+        scoring.criteria[-1].get_group_score, boost_unprioritised=True))
+
+    expected = scoring.batch(bookings)
+
+    scoring.update_scores(session, prebooking_period.id)
+
+    assert [round(float(b.score), 6) for b in bookings] \
+        == [round(score, 6) for score in expected]
+
+    # the matching may use the scores from the database
+    for b in bookings:
+        b.score = 0
+
+    session.flush()
+
+    match(session, prebooking_period.id, score_function=scoring,
+          score_in_database=True)
+
+    assert [round(float(b.score), 6) for b in bookings] \
+        == [round(score, 6) for score in expected]
+
+    assert [b.state for b in bookings] == [
+        'open', 'open', 'accepted', 'accepted', 'open', 'open'
+    ]
+
+
+def test_warm_start(session, owner, collections, prebooking_period):
+    o1 = new_occasion(collections, prebooking_period, 0, 1, spots=(0, 1))
+    o2 = new_occasion(collections, prebooking_period, 2, 1, spots=(0, 1))
+
+    a1 = new_attendee(collections)
+    a2 = new_attendee(collections)
+
+    b1 = collections.bookings.add(owner, a1, o1, priority=1)
+    b2 = collections.bookings.add(owner, a2, o1)
+
+    match(session, prebooking_period.id)
+
+    assert b1.state == 'accepted'
+    assert b2.state == 'open'
+
+    # a late wish is added, the previous result is kept
+    b3 = collections.bookings.add(owner, a2, o2)
+
+    match(session, prebooking_period.id, warm_start=True)
+
+    assert b1.state == 'accepted'
+    assert b2.state == 'open'
+    assert b3.state == 'accepted'
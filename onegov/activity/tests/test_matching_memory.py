@@ -1,9 +1,14 @@
+import pytest
+import random
 import sys
 
 from datetime import date, timedelta, datetime
 from functools import partial
 from itertools import count
+from operator import attrgetter
 from onegov.activity.utils import dates_overlap
+from onegov.activity.matching import compact_deferred_acceptance
+from onegov.activity.matching import core
 from onegov.activity.matching import deferred_acceptance
 from onegov.activity.matching import MatchableBooking
 from onegov.activity.matching import MatchableOccasion
@@ -12,8 +17,17 @@ from onegov.activity.matching import PreferInAgeBracket
 from onegov.activity.matching import PreferMotivated
 from onegov.activity.matching import PreferOrganiserChildren
 from onegov.activity.matching import Scoring
-from onegov.activity.matching.core import is_stable, OccasionAgent
-from onegov.activity.matching.utils import unblockable
+from onegov.activity.matching.benchmark import benchmark, PHASES
+from onegov.activity.matching.benchmark import SyntheticPeriod
+from onegov.activity.matching.core import AttendeeAgent, OccasionAgent
+from onegov.activity.matching.core import blocking_pairs, BlockingPair
+from onegov.activity.matching.core import is_stable
+from onegov.activity.matching.parallel import components
+from onegov.activity.matching.utils import anti_affinity_groups
+from onegov.activity.matching.utils import bits, conflict_graph, unblockable
+from onegov.activity.matching.utils import IntervalIndex, LoopBudget
+from onegov.activity.matching.utils import MatchingStats
+from onegov.activity.matching.utils import occasion_intervals
 from onegov.core.utils import Bunch
 from sedate import standardize_date
 from uuid import uuid4
@@ -113,8 +127,8 @@ class Occasion(MatchableOccasion):
     def max_spots(self):
         return self._max_spots
 
-    def booking(self, attendee, state, priority):
-        return Booking(self, attendee, state, priority, self._dates)
+    def booking(self, attendee, state, priority, score=0):
+        return Booking(self, attendee, state, priority, self._dates, score)
 
     @property
     def dates(self):
@@ -608,6 +622,28 @@ def test_booking_limit():
     }
 
 
+def test_booking_limit_after_denial():
+    o1 = Occasion(1, [[today(), today()]], max_spots=1)
+    o2 = Occasion(2, [[today() + days(1), today() + days(1)]], max_spots=1)
+
+    bookings = [
+        o1.booking("Tom", 'open', 1),
+        o2.booking("Tom", 'open', 0),
+        o1.booking("Harry", 'open', 2),
+    ]
+
+    # Tom gets his favourite first, which blocks the other booking as he
+    # reached his limit - once Harry takes his place, the other booking
+    # has to be considered again, as Tom is below the limit (his favourite
+    # stays open, as he would still take it over the other booking)
+    for engine in (match, compact_deferred_acceptance):
+        result = engine(bookings, (o1, o2), default_limit=1)
+
+        assert result.open == {bookings[0]}
+        assert result.accepted == {bookings[1], bookings[2]}
+        assert not result.blocked
+
+
 def test_day_alignment():
     o1 = Occasion(1, [
         [datetime(2017, 2, 20, 8), datetime(2017, 2, 20, 16)]
@@ -700,6 +736,34 @@ def test_unblockable_regression():
 
     assert not unblockable(accepted, blocked)
 
+    blocked.add(booking((13, 0), (14, 0)))
+    blocked.add(booking((6, 0), (7, 0)))
+
+    assert {
+        (b.dates[0].start.hour, b.dates[0].end.hour)
+        for b in unblockable(accepted, blocked)
+    } == {(6, 7), (13, 14)}
+
+    # with the settings of the period, the bookings are further apart
+    settings = Bunch(minutes_between=60, alignment=None)
+
+    assert {
+        (b.dates[0].start.hour, b.dates[0].end.hour)
+        for b in unblockable(accepted, blocked, settings=settings)
+    } == set()
+
+
+def test_interval_index():
+    index = IntervalIndex(((1, 4), (10, 12), (6, 5)))
+
+    assert index.overlaps(((4, 5), ))
+    assert index.overlaps(((0, 1), (20, 30)))
+    assert index.overlaps(((5, 8), ))
+    assert index.overlaps(((11, 10), ))
+    assert not index.overlaps(((6, 5), ))
+    assert not index.overlaps(((5, 4), (7, 9), (13, 20)))
+    assert not IntervalIndex(()).overlaps(((1, 2), ))
+
 
 def test_anti_affinity_groups():
     foo = Occasion("foo", [
@@ -730,3 +794,488 @@ def test_anti_affinity_groups():
     foo._no_overlap_check = True
     bar._no_overlap_check = True
     assert len(match(bookings, (foo, bar)).accepted) == 1
+
+    # the groups are interned and the bookings bucketed by group
+    baz = Occasion("baz", [
+        (datetime(2019, 2, 14, 8), datetime(2019, 2, 14, 16))
+    ], anti_affinity_group='zyx')
+    bookings.append(baz.booking("Tom", 'open', 0))
+
+    groups = anti_affinity_groups((foo, bar, baz))
+    assert groups == {"foo": 0, "bar": 0, "baz": 1}
+
+    assert conflict_graph(bookings, with_anti_affinity_check=True) == \
+        conflict_graph(
+            bookings, with_anti_affinity_check=True, groups=groups) == \
+        [0b011, 0b011, 0b100]
+
+
+def test_conflict_graph():
+    o1 = Occasion(1, [
+        [datetime(2019, 7, 1, 8), datetime(2019, 7, 1, 12)]
+    ])
+    o2 = Occasion(2, [
+        [datetime(2019, 7, 1, 11), datetime(2019, 7, 1, 14)]
+    ])
+    o3 = Occasion(3, [
+        [datetime(2019, 7, 1, 14), datetime(2019, 7, 1, 16)]
+    ])
+
+    bookings = [
+        o1.booking("Tom", 'open', 0),
+        o2.booking("Tom", 'open', 0),
+        o3.booking("Tom", 'open', 0),
+    ]
+
+    assert conflict_graph(bookings) == [0b011, 0b011, 0b100]
+    assert conflict_graph(bookings, minutes_between=60) == [
+        0b011, 0b111, 0b110
+    ]
+
+    # the intervals are memoised on the occasions, per settings
+    assert set(o1._intervals) == {(0, None), (60, None)}
+    assert occasion_intervals(o1) is occasion_intervals(o1)
+    assert occasion_intervals(o1) != occasion_intervals(o1, 60)
+
+    assert list(bits(0)) == []
+    assert list(bits(0b10110)) == [1, 2, 4]
+
+
+def test_compact_deferred_acceptance():
+    random.seed(42)
+
+    occasions = [
+        Occasion(i, [[
+            datetime(2019, 7, 1 + i % 5, 8 + i % 3),
+            datetime(2019, 7, 1 + i % 5, 12 + i % 4)
+        ]], max_spots=random.randint(1, 3))
+        for i in range(12)
+    ]
+
+    occasions[0]._no_overlap_check = True
+    occasions[1]._anti_affinity_group = 'foo'
+    occasions[2]._anti_affinity_group = 'foo'
+
+    bookings = [
+        o.booking(attendee, 'open', random.choice((0, 0, 1)))
+        for attendee in range(25)
+        for o in random.sample(occasions, 4)
+    ]
+
+    for kwargs in (
+        {},
+        {'minutes_between': 60},
+        {'alignment': 'day'},
+        {'default_limit': 2, 'attendee_limits': {0: 1, 1: 3}},
+    ):
+        expected = deferred_acceptance(bookings, occasions, **kwargs)
+        result = compact_deferred_acceptance(bookings, occasions, **kwargs)
+
+        assert result.open == expected.open
+        assert result.accepted == expected.accepted
+        assert result.blocked == expected.blocked
+
+
+def test_components():
+    a = Occasion("A", [[today(), today()]])
+    b = Occasion("B", [[today(), today()]])
+    c = Occasion("C", [[today(), today()]])
+
+    bookings = [
+        a.booking("Tick", 'open', 0),
+        c.booking("Trick", 'open', 0),
+        b.booking("Tick", 'open', 0),
+        b.booking("Track", 'open', 0),
+        c.booking("Tock", 'open', 0),
+    ]
+
+    assert components(bookings) == [
+        [bookings[0], bookings[2], bookings[3]],
+        [bookings[1], bookings[4]],
+    ]
+
+
+def test_parallel_deferred_acceptance():
+    random.seed(42)
+
+    occasions = [
+        Occasion(i, [[
+            datetime(2019, 7, 1 + i % 5, 8 + i % 3),
+            datetime(2019, 7, 1 + i % 5, 12 + i % 4)
+        ]], max_spots=random.randint(1, 3))
+        for i in range(12)
+    ]
+
+    occasions[1]._anti_affinity_group = 'foo'
+    occasions[2]._anti_affinity_group = 'foo'
+
+    # attendees book in one of three clusters of occasions
+    bookings = [
+        o.booking(attendee, 'open', random.choice((0, 0, 1)))
+        for attendee in range(30)
+        for o in random.sample(occasions[attendee % 3::3], 3)
+    ]
+
+    assert len(components(bookings)) == 3
+
+    for kwargs in (
+        {},
+        {'minutes_between': 60},
+        {'default_limit': 2, 'attendee_limits': {0: 1, 1: 3}},
+    ):
+        expected = match(bookings, occasions, **kwargs)
+        result = match(bookings, occasions, processes=2, **kwargs)
+
+        assert result.open == expected.open
+        assert result.accepted == expected.accepted
+        assert result.blocked == expected.blocked
+
+
+def test_warm_start(monkeypatch):
+    random.seed(42)
+
+    # the occasions prefer the attendees in the same order, which leaves
+    # a single stable result, no matter where the matching starts from
+    scores = random.sample(range(100), 30)
+    match_scores = partial(match, score_function=attrgetter('score'))
+
+    occasions = [
+        Occasion(i, [[
+            datetime(2019, 7, 1 + i % 5, 8 + i % 3),
+            datetime(2019, 7, 1 + i % 5, 12 + i % 4)
+        ]], max_spots=random.randint(1, 3))
+        for i in range(12)
+    ]
+
+    bookings = [
+        o.booking(attendee, 'open', 0, score=scores[attendee])
+        for attendee in range(25)
+        for o in random.sample(occasions, 4)
+    ]
+
+    def store(result):
+        for state in ('open', 'accepted', 'blocked'):
+            for booking in getattr(result, state):
+                booking._state = state
+
+    def assert_same(result, expected):
+        assert result.accepted == expected.accepted
+        assert result.open == expected.open
+        assert result.blocked == expected.blocked
+
+    result = match_scores(bookings, occasions)
+    store(result)
+
+    # without changes, the previous result stays the same
+    assert_same(match_scores(bookings, occasions, warm_start=True), result)
+
+    # an accepted booking is withdrawn and new wishes are added
+    withdrawn = next(iter(result.accepted))
+    bookings.remove(withdrawn)
+
+    late = [
+        o.booking(attendee, 'open', 0, score=scores[attendee])
+        for attendee in range(25, 30)
+        for o in random.sample(occasions, 2)
+    ]
+    bookings.extend(late)
+
+    cold = match_scores(bookings, occasions)
+    warm = match_scores(bookings, occasions, warm_start=True)
+
+    assert withdrawn not in warm.accepted
+    assert warm.accepted & set(late)
+    assert_same(warm, cold)
+
+    # if the warm start leads to an unstable result, the matching starts
+    # over, without counting the input twice
+    warm_up = core.warm_up
+    fallback = []
+
+    def unstable_warm_up(attendees, occasions, bookings, rejected):
+        warm_up(attendees, occasions, bookings, rejected)
+
+        for attendee in attendees.values():
+            for booking in attendee.wishlist:
+                rejected[booking.occasion_id].add(booking)
+
+    def cold_start(*args, **kwargs):
+        fallback.append(kwargs)
+        return deferred_acceptance(*args, **kwargs)
+
+    monkeypatch.setattr(core, 'warm_up', unstable_warm_up)
+    monkeypatch.setattr(core, 'deferred_acceptance', cold_start)
+
+    stats = MatchingStats()
+    warm = match_scores(bookings, occasions, warm_start=True, stats=stats)
+
+    assert len(fallback) == 1
+    assert not fallback[0].get('warm_start')
+    assert_same(warm, cold)
+
+    cold_stats = MatchingStats()
+    match_scores(bookings, occasions, stats=cold_stats)
+
+    assert stats.attendees == cold_stats.attendees == 30
+    assert stats.bookings == cold_stats.bookings == len(bookings)
+    assert stats.overlap_checks == cold_stats.overlap_checks
+
+
+def test_blocking_pairs():
+    o1 = Occasion("A", [[today(), today()]], max_spots=1)
+    o2 = Occasion("B", [[today() + days(1), today() + days(1)]])
+
+    b1 = o1.booking("Tick", 'open', 0, score=1)
+    b2 = o1.booking("Trick", 'open', 0, score=2)
+    b3 = o2.booking("Trick", 'open', 0, score=1)
+
+    tick = AttendeeAgent("Tick", [b1])
+    trick = AttendeeAgent("Trick", [b2, b3], limit=1)
+
+    occasions = [OccasionAgent(o1), OccasionAgent(o2)]
+    occasions[0].accept(tick, b1)
+    occasions[1].accept(trick, b3)
+
+    # the occasion prefers Trick, who prefers the occasion over the other
+    assert blocking_pairs((tick, trick), occasions) == [
+        BlockingPair("Trick", b2)
+    ]
+
+    occasions[1].deny(b3)
+    occasions[0].deny(b1)
+    occasions[0].accept(trick, b2)
+
+    assert blocking_pairs((tick, trick), occasions) == []
+
+
+def test_regain_preferred_booking():
+
+    def hours(start, end):
+        return [[datetime(2017, 2, 16, start), datetime(2017, 2, 16, end)]]
+
+    # B overlaps with A and C, but A does not overlap with C
+    o1 = Occasion("A", hours(9, 11), max_spots=1)
+    o2 = Occasion("B", hours(10, 13))
+    o3 = Occasion("C", hours(12, 14), max_spots=1)
+    o4 = Occasion("D", [[today() + days(1), today() + days(1)]])
+
+    bookings = [
+        o1.booking("Zick", 'open', 0, score=3),
+        o2.booking("Zick", 'open', 0, score=2),
+        o3.booking("Zick", 'open', 0, score=1),
+        o4.booking("Zack", 'open', 0, score=6),
+        o1.booking("Zack", 'open', 0, score=5),
+        o3.booking("Tick", 'open', 0, score=0),
+    ]
+
+    # Zick gets A and C, then loses A to Zack - as B is preferred and
+    # free, Zick takes it and gives up C, which then goes to Tick
+    for engine in (match, compact_deferred_acceptance):
+        stats = MatchingStats()
+        result = engine(
+            bookings, (o1, o2, o3, o4), score_function=attrgetter('score'),
+            stats=stats)
+
+        assert result.open == {bookings[0]}
+        assert result.accepted == {
+            bookings[1], bookings[3], bookings[4], bookings[5]}
+        assert result.blocked == {bookings[2]}
+        assert stats.releases == 1
+
+
+def test_matching_stats():
+    o1 = Occasion("A", [[today(), today()]], max_spots=1)
+    o2 = Occasion("B", [[today() + days(1), today() + days(1)]])
+
+    # Zick proposes first and is evicted by the motivated Trick
+    bookings = [
+        o1.booking("Zick", 'open', 0),
+        o2.booking("Zick", 'open', 0),
+        o1.booking("Trick", 'open', 1),
+    ]
+
+    reported = []
+
+    class Stats(MatchingStats):
+        def report(self, phase, duration):
+            reported.append(phase)
+
+    stats = Stats()
+    result = match(bookings, (o1, o2), stats=stats)
+
+    assert result.accepted == {bookings[1], bookings[2]}
+    assert reported == [
+        'scoring', 'setup', 'proposals', 'validity', 'stability'
+    ]
+    assert set(stats.phases) == set(reported)
+
+    assert stats.attendees == 2
+    assert stats.bookings == 3
+    assert stats.overlap_checks == 1
+    assert stats.evictions == 1
+    assert stats.proposals == stats.budget_ticks
+    assert stats.proposals == len(result.accepted) + stats.evictions \
+        + stats.rejections
+
+    assert 'proposals: {}'.format(stats.proposals) in str(stats)
+
+
+def test_proposal_queue(monkeypatch):
+    o1 = Occasion("A", [[today(), today()]], max_spots=1)
+    o2 = Occasion("B", [[today(), today()]])
+    o3 = Occasion("C", [[today() + days(1), today() + days(1)]])
+
+    bookings = [
+        o1.booking("Zick", 'open', 0, score=1),
+        o2.booking("Zick", 'open', 0, score=0),
+        o1.booking("Trick", 'open', 0, score=2),
+        o3.booking("Track", 'open', 0, score=0),
+    ]
+
+    proposals = []
+    original = OccasionAgent.match
+
+    def record(self, attendee, booking):
+        proposals.append((attendee.id, booking.occasion_id))
+        return original(self, attendee, booking)
+
+    monkeypatch.setattr(OccasionAgent, 'match', record)
+
+    stats = MatchingStats()
+    result = match(
+        bookings, (o1, o2, o3), score_function=attrgetter('score'),
+        stats=stats)
+
+    # the attendees are queued in reverse order - Zick is evicted by Trick
+    # and queued again behind Track, who has not proposed yet
+    assert proposals == [
+        ("Zick", "A"),
+        ("Trick", "A"),
+        ("Track", "C"),
+        ("Zick", "B"),
+    ]
+
+    # Zick gets one more turn, as the rejected booking is still open
+    assert stats.turns == 5
+    assert result.accepted == {bookings[1], bookings[2], bookings[3]}
+
+
+def test_proposal_budget(monkeypatch):
+    o1 = Occasion("A", [[today(), today()]], max_spots=1)
+
+    bookings = [
+        o1.booking("Tick", 'open', 0),
+        o1.booking("Trick", 'open', 1),
+    ]
+
+    # a budget of a single proposal runs out before Tick proposes
+    for module in ('core', 'compact'):
+        monkeypatch.setattr(
+            'onegov.activity.matching.{}.LoopBudget'.format(module),
+            lambda max_ticks: LoopBudget(max_ticks=1))
+
+    for engine in (deferred_acceptance, compact_deferred_acceptance):
+        with pytest.raises(RuntimeError):
+            engine(bookings, (o1, ), hard_budget=True)
+
+        stats = MatchingStats()
+        result = engine(bookings, (o1, ), hard_budget=False, stats=stats)
+
+        assert result.accepted == {bookings[1]}
+        assert result.open == {bookings[0]}
+        assert stats.proposals == stats.budget_ticks == 1
+
+
+def test_occasion_agent_ranking():
+    o = Occasion("Zoo", [[today(), today()]], max_spots=2)
+
+    bookings = [
+        o.booking("Tick", 'open', 0, score=1),
+        o.booking("Trick", 'open', 0, score=2),
+        o.booking("Track", 'open', 0, score=3),
+        o.booking("Tock", 'open', 0, score=1),
+    ]
+
+    attendees = {
+        b: Bunch(accept=lambda b: None, deny=lambda b: None)
+        for b in bookings
+    }
+
+    agent = OccasionAgent(o)
+    assert agent.threshold is None
+    assert agent.preferred(bookings[2]) is None
+
+    assert agent.match(attendees[bookings[1]], bookings[1])
+    assert agent.match(attendees[bookings[0]], bookings[0])
+    assert agent.threshold == 1
+    assert agent.preferred(bookings[2]) == bookings[0]
+
+    assert not agent.match(attendees[bookings[3]], bookings[3])
+    assert agent.match(attendees[bookings[2]], bookings[2])
+    assert agent.bookings == {bookings[1], bookings[2]}
+    assert agent.threshold == 2
+
+
+def test_scoring_batch():
+    calls = []
+
+    def get_age_range(booking):
+        calls.append(booking.occasion_id)
+        return {'a': (6, 10), 'b': (12, 16)}[booking.occasion_id]
+
+    def get_attendee_age(booking):
+        return {'tom': 8, 'ann': 18}[booking.attendee_id]
+
+    scoring = Scoring(criteria=[
+        PreferMotivated(),
+        PreferInAgeBracket(get_age_range, get_attendee_age),
+        PreferOrganiserChildren(lambda b: b.username == 'organiser'),
+        PreferAdminChildren(lambda b: b.username == 'admin'),
+        lambda b: 0.5,
+    ])
+
+    bookings = [
+        Bunch(priority=p, occasion_id=o, attendee_id=a, username=u)
+        for p, o, a, u in (
+            (0, 'a', 'tom', 'organiser'),
+            (1, 'b', 'tom', 'organiser'),
+            (0, 'a', 'ann', 'admin'),
+            (1, 'b', 'ann', 'member'),
+        )
+    ]
+
+    assert scoring.batch(bookings) == [2.5, 3.1, 1.7, 2.3]
+    assert calls == ['a', 'b']
+
+    assert scoring.batch(bookings) == [scoring(b) for b in bookings]
+    assert scoring.batch([]) == []
+
+
+def test_synthetic_period():
+    period = SyntheticPeriod(attendees=50, wishes=4, seed=1)
+
+    assert len(period.bookings) == 200
+    assert len({b.attendee_id for b in period.bookings}) == 50
+    assert any(b.group_code for b in period.bookings)
+
+    # the same seed leads to the same period
+    assert [b.id for b in SyntheticPeriod(
+        attendees=50, wishes=4, seed=1).bookings
+    ] == [b.id for b in period.bookings]
+
+    result = match(period.bookings, period.occasions,
+                   score_function=period.scoring())
+
+    assert result.accepted
+
+    record = benchmark(period, repeat=1)
+
+    assert set(record['phases']) == set(PHASES)
+    assert record['phases']['total'] > 0
+    assert record['phases']['total'] >= record['phases']['proposals']
+    assert record['counters']['proposals'] >= len(result.accepted)
+    assert record['accepted'] == len(result.accepted)
+    assert record['peak_memory'] > 0
+
+    with pytest.raises(ValueError):
+        benchmark(period, repeat=0)
@@ -4,22 +4,26 @@ import transaction
 
 from datetime import datetime, date, timedelta
 from freezegun import freeze_time
-from onegov.activity import ActivityCollection
+from onegov.activity import Activity, ActivityCollection
 from onegov.activity import ActivityFilter
 from onegov.activity import Attendee
 from onegov.activity import AttendeeCollection
 from onegov.activity import Booking, BookingCollection
 from onegov.activity import Invoice, InvoiceCollection
+from onegov.activity.errors import BookingLimitReached
+from onegov.activity.matching.utils import occasion_intervals
 from onegov.activity.models.invoice_reference import FeriennetSchema
 from onegov.activity.models.invoice_reference import ESRSchema
 from onegov.activity import Occasion, OccasionDate
 from onegov.activity import OccasionCollection
+from onegov.activity import OccasionSearch
 from onegov.activity import Period
 from onegov.activity import PeriodCollection
 from onegov.activity import PublicationRequestCollection
 from onegov.activity.models import DAYS
+from onegov.activity.utils import padded_intervals
 from onegov.core.utils import Bunch
-from sqlalchemy import func
+from sqlalchemy import event, func
 from sqlalchemy.exc import IntegrityError
 from psycopg2.extras import NumericRange
 from pytz import utc
@@ -437,6 +441,56 @@ def test_occasion_daterange_constraint(session, owner):
         )
 
 
+def test_occasion_intervals(session, owner):
+    period = PeriodCollection(session).add(
+        title="Autumn 2016",
+        prebooking=(datetime(2016, 9, 1), datetime(2016, 9, 30)),
+        execution=(datetime(2016, 10, 1), datetime(2016, 10, 31))
+    )
+
+    occasions = OccasionCollection(session)
+    occasions.add(
+        start=datetime(2016, 10, 4, 13),
+        end=datetime(2016, 10, 4, 14),
+        timezone="Europe/Zurich",
+        activity=ActivityCollection(session).add(
+            "Sport", username=owner.username),
+        period=period
+    )
+    transaction.commit()
+
+    occasion = occasions.query().one()
+    before = occasion_intervals(occasion)
+
+    # dates changed in place are not seen by the occasion until flushed
+    occasion.dates[0].end += timedelta(hours=1)
+    longer = occasion_intervals(occasion)
+
+    assert longer != before
+    assert longer == padded_intervals(
+        (d.start, d.end) for d in occasion.dates)
+
+    # the same holds for dates loaded on their own
+    date = session.query(OccasionDate).one()
+    date.start -= timedelta(hours=1)
+
+    assert occasion_intervals(occasion) != longer
+    assert occasion_intervals(occasion) == padded_intervals(
+        ((date.start, date.end), ))
+
+    # nothing is kept once the occasion is expired or refreshed
+    transaction.commit()
+
+    occasion = occasions.query().one()
+    occasion_intervals(occasion)
+    session.expire(occasion)
+    assert occasion._intervals is None
+
+    occasion_intervals(occasion)
+    session.refresh(occasion)
+    assert occasion._intervals is None
+
+
 def test_no_orphan_bookings(session, owner):
 
     activities = ActivityCollection(session)
@@ -1557,6 +1611,87 @@ def test_accept_booking(session, owner):
     assert b2.state == 'blocked'
 
 
+def test_accept_bookings(session, owner):
+    activities = ActivityCollection(session)
+    attendees = AttendeeCollection(session)
+    periods = PeriodCollection(session)
+    occasions = OccasionCollection(session)
+    bookings = BookingCollection(session)
+
+    period = periods.add(
+        title="Autumn 2016",
+        prebooking=(datetime(2016, 9, 1), datetime(2016, 9, 30)),
+        execution=(datetime(2016, 10, 1), datetime(2016, 10, 31)),
+        active=True,
+    )
+
+    def occasion(name, day, hour):
+        return occasions.add(
+            start=datetime(2016, 10, day, hour),
+            end=datetime(2016, 10, day, hour + 1),
+            timezone="Europe/Zurich",
+            activity=activities.add(name, username=owner.username),
+            period=period,
+            spots=(0, 2)
+        )
+
+    o1 = occasion("Activity 1", 4, 13)
+    o2 = occasion("Activity 2", 4, 13)
+    o3 = occasion("Activity 3", 5, 13)
+
+    a1, a2, a3 = (
+        attendees.add(
+            user=owner,
+            name=name,
+            birth_date=date(2000, 1, 1),
+            gender='male'
+        ) for name in ("Dustin Henderson", "Mike Wheeler", "Will Byers")
+    )
+
+    period.confirmed = True
+    session.flush()
+
+    b1 = bookings.add(owner, a1, o1)
+    b2 = bookings.add(owner, a2, o1)
+    b3 = bookings.add(owner, a3, o1)
+    b4 = bookings.add(owner, a1, o2)
+    b5 = bookings.add(owner, a1, o3)
+
+    results = bookings.accept_bookings((b1, b2, b3, b4, b5))
+
+    assert list(results) == [b1, b2, b3, b4, b5]
+    assert results[b1] is None
+    assert results[b2] is None
+    assert "The occasion is already full" in str(results[b3])
+    assert "Only open/denied bookings" in str(results[b4])
+    assert results[b5] is None
+
+    assert [b.state for b in (b1, b2, b3, b4, b5)] == [
+        'accepted', 'accepted', 'open', 'blocked', 'accepted'
+    ]
+
+    session.refresh(o1)
+    session.refresh(o3)
+
+    assert o1.attendee_count == 2
+    assert o3.attendee_count == 1
+
+    # the booking limit is checked as well
+    period.all_inclusive = True
+    period.max_bookings_per_attendee = 1
+
+    b6 = bookings.add(owner, a2, o3)
+    b7 = bookings.add(owner, a3, o3)
+
+    results = bookings.accept_bookings((b6, b7))
+
+    assert isinstance(results[b6], BookingLimitReached)
+    assert results[b7] is None
+    assert b6.state == 'open'
+    assert b7.state == 'accepted'
+    assert bookings.accept_bookings(()) == {}
+
+
 def test_booking_limit_exemption(session, owner):
     activities = ActivityCollection(session)
     attendees = AttendeeCollection(session)
@@ -1865,6 +2000,35 @@ def test_cancel_booking(session, owner):
     assert b2.state == 'accepted'
     assert b3.state == 'denied'
 
+    transaction.abort()
+
+    # the waiting bookings of the cancelled occasion are considered, even
+    # if bookings of the attendee were unblocked
+    b1 = bookings.add(owner, a1, o1)
+    b2 = bookings.add(owner, a1, o2)
+    b3 = bookings.add(owner, a2, o1)
+    b4 = bookings.add(owner, a3, o1)
+
+    bookings.accept_booking(b1)
+    bookings.accept_booking(b3)
+
+    assert b2.state == 'blocked'
+    assert b4.state == 'open'
+
+    bookings.cancel_booking(b1)
+
+    assert b1.state == 'cancelled'
+    assert b2.state == 'accepted'
+    assert b3.state == 'accepted'
+    assert b4.state == 'accepted'
+
+    def attendee_count(occasion):
+        return session.query(Occasion.attendee_count)\
+            .filter_by(id=occasion.id).scalar()
+
+    assert attendee_count(o1) == 2
+    assert attendee_count(o2) == 1
+
 
 def test_period_phases(session):
     periods = PeriodCollection(session)
@@ -2148,6 +2312,26 @@ def test_confirm_period(session, owner):
 
     assert bookings.query().one().cost == 20.0
 
+    transaction.abort()
+
+    # the bookings may also be confirmed one by one, with the same result
+    for set_based in (True, False):
+        period = periods.query().one()
+        period.booking_cost = 5
+
+        b1 = bookings.add(owner, a1, o)
+        b2 = bookings.add(owner, a2, o)
+        b2.state = 'accepted'
+
+        period.confirm(set_based=set_based)
+
+        assert period.confirmed
+        assert b1.state == 'denied'
+        assert b2.state == 'accepted'
+        assert b1.cost == b2.cost == 25.0
+
+        transaction.abort()
+
 
 def test_cancel_occasion(session, owner):
 
@@ -2222,6 +2406,28 @@ def test_cancel_occasion(session, owner):
     assert o1.cancelled
     assert not o2.cancelled
 
+    transaction.abort()
+
+    # the bookings of all attendees are unblocked at once
+    periods.active().confirmed = True
+    o1, o2 = occasions.query().all()
+
+    b1 = bookings.add(owner, a1, o1)
+    b2 = bookings.add(owner, a1, o2)
+    b3 = bookings.add(owner, a2, o1)
+    b4 = bookings.add(owner, a2, o2)
+
+    b1.state = b3.state = 'accepted'
+    b2.state = b4.state = 'blocked'
+
+    o1.cancel()
+
+    assert b1.state == 'cancelled'
+    assert b2.state == 'accepted'
+    assert b3.state == 'cancelled'
+    assert b4.state == 'accepted'
+    assert o1.cancelled
+
 
 def test_no_overlapping_dates(session, collections, prebooking_period, owner):
     period = prebooking_period
@@ -2339,6 +2545,208 @@ def test_age_barriers(prebooking_period):
     assert o.is_too_old(date(2007, 12, 31))
 
 
+def test_period_settings(session, prebooking_period):
+    period = prebooking_period
+    period.all_inclusive = True
+    period.max_bookings_per_attendee = 2
+
+    settings = period.settings
+    assert settings.minutes_between == 0
+    assert settings.alignment is None
+    assert settings.booking_limit == 2
+    assert settings.all_inclusive
+    assert settings.age_barrier.__class__.__name__ == 'ExactAgeBarrier'
+
+    # the settings are cached until they change
+    assert period.settings is settings
+
+    period.minutes_between = 30
+    assert period.settings.minutes_between == 30
+
+    period.all_inclusive = False
+    assert period.settings.booking_limit is None
+
+    period.age_barrier_type = 'year'
+    assert period.settings.age_barrier.__class__.__name__ == 'YearAgeBarrier'
+
+    # changes made elsewhere are picked up after an expiry
+    settings = period.settings
+    session.flush()
+    session.execute("UPDATE periods SET alignment = 'day'")
+    session.expire(period)
+
+    assert period.settings is not settings
+    assert period.settings.alignment == 'day'
+
+    with pytest.raises(AttributeError):
+        period.settings.alignment = None
+
+
+def test_period_phase_snapshot(session):
+    periods = PeriodCollection(session)
+
+    period = periods.add(
+        title="Autumn 2016",
+        prebooking=(date(2016, 9, 1), date(2016, 9, 30)),
+        execution=(date(2016, 11, 1), date(2016, 11, 30)),
+        active=True,
+    )
+
+    with freeze_time('2016-09-01'):
+        snapshot = period.phase_snapshot
+        assert snapshot.phase == 'wishlist'
+        assert snapshot.day == date(2016, 9, 1)
+        assert snapshot.today == period.as_local_datetime(date(2016, 9, 1))
+        assert snapshot.prebooking_end \
+            == period.as_local_datetime(date(2016, 9, 30))
+
+        # the snapshot is cached until the period changes
+        assert period.phase_snapshot is snapshot
+
+        period.prebooking_end = date(2016, 9, 15)
+        assert period.phase_snapshot is not snapshot
+        assert period.phase_snapshot.prebooking_end \
+            == period.as_local_datetime(date(2016, 9, 15))
+
+        period.confirmed = True
+        assert period.phase == 'booking'
+
+    # or until the day changes
+    with freeze_time('2016-09-02'):
+        assert period.phase_snapshot.day == date(2016, 9, 2)
+
+    # changes made elsewhere are picked up after an expiry
+    with freeze_time('2016-11-01'):
+        session.flush()
+        session.execute("UPDATE periods SET finalized = TRUE")
+        assert period.phase == 'booking'
+
+        session.expire(period)
+        assert period.phase == 'execution'
+
+    with pytest.raises(AttributeError):
+        period.phase_snapshot.phase = 'archive'
+
+
+def test_active_period(session):
+    periods = PeriodCollection(session)
+
+    assert periods.active() is None
+
+    autumn = periods.add(
+        title="Autumn 2016",
+        prebooking=(date(2016, 9, 1), date(2016, 9, 30)),
+        execution=(date(2016, 11, 1), date(2016, 11, 30)),
+        active=True,
+    )
+
+    winter = periods.add(
+        title="Winter 2016",
+        prebooking=(date(2016, 12, 1), date(2016, 12, 31)),
+        execution=(date(2017, 1, 1), date(2017, 1, 31)),
+        active=False,
+    )
+
+    assert periods.active() == autumn
+    assert PeriodCollection(session).active() == autumn
+
+    winter.activate()
+    assert periods.active() == winter
+
+    winter.deactivate()
+    assert periods.active() is None
+
+    autumn.activate()
+    session.flush()
+    assert periods.active() == autumn
+
+    session.delete(autumn)
+    assert periods.active() is None
+
+
+def test_active_period_snapshot(session):
+    PeriodCollection.active_periods.clear()
+
+    periods = PeriodCollection(session)
+    assert periods.active_snapshot() is None
+
+    periods.add(
+        title="Autumn 2016",
+        prebooking=(date(2016, 9, 1), date(2016, 9, 30)),
+        execution=(date(2016, 11, 1), date(2016, 11, 30)),
+        active=True,
+    )
+    periods.add(
+        title="Winter 2016",
+        prebooking=(date(2016, 12, 1), date(2016, 12, 31)),
+        execution=(date(2017, 1, 1), date(2017, 1, 31)),
+        active=False,
+    )
+
+    # the changes of a transaction are not cached before they are committed
+    assert periods.active_snapshot().title == "Autumn 2016"
+    assert session.info['schema'] not in PeriodCollection.active_periods
+
+    transaction.commit()
+
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    engine = session.get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+
+    try:
+        with freeze_time('2016-09-01'):
+            snapshot = periods.active_snapshot()
+            assert snapshot.phase.phase == 'wishlist'
+            assert snapshot.settings.minutes_between == 0
+            queries = len(statements)
+
+            # once cached, the snapshot is read without any query
+            assert PeriodCollection(session).active_snapshot() is snapshot
+            assert len(statements) == queries
+
+        # the phase is only cached for the day
+        with freeze_time('2016-08-31'):
+            assert periods.active_snapshot().phase.phase == 'inactive'
+            assert len(statements) > queries
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+    # activating or deactivating a period discards the snapshot right away
+    winter = periods.query().filter_by(title="Winter 2016").one()
+    winter.activate()
+    assert periods.active_snapshot().title == "Winter 2016"
+
+    winter.deactivate()
+    assert periods.active_snapshot() is None
+
+    transaction.commit()
+    assert periods.active_snapshot() is None
+    assert PeriodCollection.active_periods[session.info['schema']] is None
+
+    # so does any other change of a period
+    autumn = periods.query().filter_by(title="Autumn 2016").one()
+    autumn.active = True
+    transaction.commit()
+
+    assert periods.active_snapshot().settings.minutes_between == 0
+
+    autumn = periods.query().filter_by(title="Autumn 2016").one()
+    autumn.minutes_between = 30
+    session.flush()
+    assert session.info['schema'] not in PeriodCollection.active_periods
+    assert periods.active_snapshot().settings.minutes_between == 30
+
+    # changes which are rolled back are not cached
+    transaction.abort()
+    assert periods.active_snapshot().settings.minutes_between == 0
+    assert PeriodCollection.active_periods[session.info['schema']] \
+        .settings.minutes_between == 0
+
+
 def test_deadline(session, collections, prebooking_period, owner):
     period = prebooking_period
 
@@ -2440,6 +2848,16 @@ def test_publication_request(session, owner):
     assert request.period.title == "Autumn 2016"
 
 
+class ArchivedWithNote(Activity):
+    """ An activity which archives itself differently. """
+
+    __mapper_args__ = {'polymorphic_identity': 'archived-with-note'}
+
+    def archive(self):
+        self.lead = "Archived"
+        return super().archive()
+
+
 def test_archive_period(session, owner):
 
     activities = ActivityCollection(session)
@@ -2460,57 +2878,248 @@ def test_archive_period(session, owner):
         active=False
     )
 
+    # a period starting at the same time counts as a newer period
+    parallel_period = periods.add(
+        title="Autumn 2017 (Camp)",
+        prebooking=(datetime(2017, 9, 1), datetime(2017, 9, 30)),
+        execution=(datetime(2017, 10, 1), datetime(2017, 10, 15)),
+        active=False
+    )
+
+    past_period = periods.add(
+        title="Summer 2017",
+        prebooking=(datetime(2017, 5, 1), datetime(2017, 5, 31)),
+        execution=(datetime(2017, 7, 1), datetime(2017, 7, 31)),
+        active=False
+    )
+
     sport = activities.add("Sport", username=owner.username)
     games = activities.add("Games", username=owner.username)
     empty = activities.add("Empty", username=owner.username)
+    camp = activities.add("Camp", username=owner.username)
+    music = activities.add("Music", username=owner.username)
+    draft = activities.add("Draft", username=owner.username)
+
+    notes = ActivityCollection(session, type='archived-with-note')
+    noted = notes.add("Noted", username=owner.username)
+    ongoing = notes.add("Ongoing", username=owner.username)
+
+    for activity in (sport, games, empty, camp, music, noted, ongoing):
+        activity.propose().accept()
+
+    def add_occasion(activity, period, start):
+        occasions.add(
+            start=start,
+            end=start + timedelta(hours=1),
+            timezone="Europe/Zurich",
+            meeting_point="Lucerne",
+            age=(6, 9),
+            spots=(2, 10),
+            note="Bring game-face",
+            activity=activity,
+            period=period
+        )
+
+    add_occasion(sport, current_period, datetime(2017, 10, 4, 13))
+    add_occasion(sport, future_period, datetime(2017, 12, 4, 13))
+    add_occasion(games, current_period, datetime(2017, 12, 4, 13))
+    add_occasion(camp, current_period, datetime(2017, 10, 5, 13))
+    add_occasion(camp, parallel_period, datetime(2017, 10, 5, 13))
+    add_occasion(music, past_period, datetime(2017, 7, 4, 13))
+    add_occasion(noted, current_period, datetime(2017, 10, 6, 13))
+    add_occasion(ongoing, current_period, datetime(2017, 10, 7, 13))
+    add_occasion(ongoing, future_period, datetime(2017, 12, 7, 13))
 
-    sport.propose().accept()
-    games.propose().accept()
+    current_period.confirmed = True
+    current_period.finalized = True
+
+    # games, empty and noted are archived
+    assert current_period.archive() == 3
+
+    assert current_period.archived == True
+    assert sport.state == 'accepted'
+    assert games.state == 'archived'
+    assert empty.state == 'archived'
+    assert camp.state == 'accepted'
+    assert music.state == 'accepted'
+    assert draft.state == 'preview'
+
+    # the activities which override the archiving are archived through it
+    assert noted.state == 'archived'
+    assert noted.lead == "Archived"
+    assert ongoing.state == 'accepted'
+    assert ongoing.lead is None
+
+    transaction.commit()
+
+    assert {a.title for a in session.query(Activity).filter_by(
+        state='archived')} == {"Games", "Empty", "Noted"}
+
+
+def test_archive_period_observed(session, owner):
+    activities = ActivityCollection(session)
+    periods = PeriodCollection(session)
+
+    period = periods.add(
+        title="Autumn 2017",
+        prebooking=(datetime(2017, 9, 1), datetime(2017, 9, 30)),
+        execution=(datetime(2017, 10, 1), datetime(2017, 10, 31)),
+        active=True
+    )
+    period.confirmed = True
+    period.finalized = True
+
+    empty = activities.add("Empty", username=owner.username)
     empty.propose().accept()
+    transaction.commit()
 
-    occasions.add(
-        start=datetime(2017, 10, 4, 13),
-        end=datetime(2017, 10, 4, 14),
-        timezone="Europe/Zurich",
-        meeting_point="Lucerne",
-        age=(6, 9),
-        spots=(2, 10),
-        note="Bring game-face",
-        activity=sport,
-        period=current_period
+    updated = []
+
+    def on_update(schema, obj):
+        updated.append(obj)
+
+    # with receivers of updated objects, the activities are archived
+    # through the ORM, so the receivers see them
+    period = periods.query().one()
+    period.session_manager.on_update.connect(on_update)
+
+    assert period.archive() == 1
+    session.flush()
+
+    assert [o.title for o in updated if isinstance(o, Activity)] \
+        == ["Empty"]
+
+
+def test_occasion_search(session, owner):
+    activities = ActivityCollection(session)
+    attendees = AttendeeCollection(session)
+    periods = PeriodCollection(session)
+    occasions = OccasionCollection(session)
+    bookings = BookingCollection(session)
+
+    period = periods.add(
+        title="Autumn 2016",
+        prebooking=(datetime(2016, 9, 1), datetime(2016, 9, 30)),
+        execution=(datetime(2016, 10, 1), datetime(2016, 10, 31)),
+        active=True,
     )
-    occasions.add(
-        start=datetime(2017, 12, 4, 13),
-        end=datetime(2017, 12, 4, 14),
+
+    occasion = occasions.add(
+        start=datetime(2016, 10, 4, 13),
+        end=datetime(2016, 10, 4, 14),
         timezone="Europe/Zurich",
-        meeting_point="Lucerne",
+        activity=activities.add("Sport", username=owner.username),
+        period=period,
         age=(6, 9),
-        spots=(2, 10),
-        note="Bring game-face",
-        activity=sport,
-        period=future_period
+        spots=(0, 4),
+        cost=100
     )
-    occasions.add(
-        start=datetime(2017, 12, 4, 13),
-        end=datetime(2017, 12, 4, 14),
+
+    def entry():
+        session.flush()
+        return session.query(OccasionSearch).populate_existing().one()
+
+    assert entry().activity_id == occasion.activity_id
+    assert entry().period_id == period.id
+    assert entry().price == 100
+    assert entry().age == occasion.age
+    assert entry().active_days == [date(2016, 10, 4).toordinal()]
+    assert entry().weekdays == [1]
+    assert entry().duration == DAYS.half
+    assert entry().availability == 'many'
+
+    # the entry follows the changes of the period
+    period.all_inclusive = False
+    period.booking_cost = 10
+    assert entry().price == 110
+
+    # ...of the occasion and its dates
+    occasion.cost = 50
+    occasions.add_date(
+        occasion,
+        datetime(2016, 10, 5, 13),
+        datetime(2016, 10, 5, 14),
+        "Europe/Zurich"
+    )
+    assert entry().price == 60
+    assert sorted(entry().weekdays) == [1, 2]
+    assert entry().duration == DAYS.many
+
+    # ...and of its bookings
+    attendee = attendees.add(
+        user=owner,
+        name="Dustin Henderson",
+        birth_date=date(2008, 1, 1),
+        gender='male'
+    )
+
+    booking = bookings.add(owner, attendee, occasion)
+    assert entry().availability == 'many'
+
+    booking.state = 'accepted'
+    assert entry().availability == 'few'
+
+    occasion.cancelled = True
+    assert entry().availability == 'none'
+
+    # changes which are not copied to the entry do not refresh it
+    session.execute(OccasionSearch.__table__.delete())
+    occasion.note = "Bring a towel"
+    session.flush()
+    assert not session.query(OccasionSearch).count()
+
+    # the table may be rebuilt from scratch
+    OccasionSearch.refresh(session)
+    assert entry().price == 60
+    assert entry().availability == 'none'
+
+
+class CampPeriod(Period):
+    """ A period of a custom model. """
+
+
+def test_occasion_search_subclass(session, owner):
+
+    class CampPeriodCollection(PeriodCollection):
+
+        @property
+        def model_class(self):
+            return CampPeriod
+
+    period = CampPeriodCollection(session).add(
+        title="Autumn 2016",
+        prebooking=(datetime(2016, 9, 1), datetime(2016, 9, 30)),
+        execution=(datetime(2016, 10, 1), datetime(2016, 10, 31)),
+        active=True,
+    )
+
+    assert isinstance(period, CampPeriod)
+
+    occasion = OccasionCollection(session).add(
+        start=datetime(2016, 10, 4, 13),
+        end=datetime(2016, 10, 4, 14),
         timezone="Europe/Zurich",
-        meeting_point="Lucerne",
-        age=(6, 9),
-        spots=(2, 10),
-        note="Bring game-face",
-        activity=games,
-        period=current_period
+        activity=ActivityCollection(session).add(
+            "Camp", username=owner.username),
+        period=period,
+        spots=(0, 4),
+        cost=100
     )
 
-    current_period.confirmed = True
-    current_period.finalized = True
+    def entry():
+        session.flush()
+        return session.query(OccasionSearch).populate_existing().one()
 
-    current_period.archive()
+    assert entry().occasion_id == occasion.id
+    assert entry().price == 100
 
-    assert current_period.archived == True
-    assert sport.state == 'accepted'
-    assert games.state == 'archived'
-    assert empty.state == 'archived'
+    # the entries follow the changes of subclasses as well
+    period.all_inclusive = False
+    period.booking_cost = 10
+    assert entry().price == 110
+
+    period.all_inclusive = True
+    assert entry().price == 100
 
 
 def test_activity_filter_toggle():
@@ -2605,6 +3214,89 @@ def test_activity_cost_filter(scenario):
     assert a.for_filter(price_range=(101, 1000)).query().count() == 0
 
 
+def test_activity_facets(scenario):
+    scenario.add_period()
+
+    scenario.add_activity(tags=['sport', 'fun'], municipality='Bern')
+    scenario.add_occasion(
+        start=datetime(2024, 1, 1, 10),
+        end=datetime(2024, 1, 1, 11),
+        age=(6, 9),
+        spots=(0, 2)
+    )
+
+    scenario.add_activity(tags=['dance', 'fun'], municipality='Thun')
+    scenario.add_occasion(
+        start=datetime(2024, 1, 3, 10),
+        end=datetime(2024, 1, 3, 11),
+        age=(10, 12)
+    )
+
+    scenario.add_activity(tags=['fun'], municipality='Bern')
+
+    a = scenario.c.activities
+
+    assert a.facets() == {
+        'tags': {'sport': 1, 'dance': 1, 'fun': 3},
+        'durations': {DAYS.half: 2},
+        'age_ranges': {},
+        'weekdays': {0: 1, 2: 1},
+        'municipalities': {'Bern': 2, 'Thun': 1},
+        'available': {'few': 1, 'many': 1}
+    }
+
+    assert a.facets(age_ranges=((6, 7), (11, 20), (13, 20)))['age_ranges'] \
+        == {(6, 7): 1, (11, 20): 1}
+
+    # the filter of a facet is ignored for its own counts
+    a = a.for_filter(tag='dance')
+
+    assert a.facets() == {
+        'tags': {'sport': 1, 'dance': 1, 'fun': 3},
+        'durations': {DAYS.half: 1},
+        'age_ranges': {},
+        'weekdays': {2: 1},
+        'municipalities': {'Thun': 1},
+        'available': {'many': 1}
+    }
+
+    a = scenario.c.activities.for_filter(weekday=0)
+
+    assert a.facets() == {
+        'tags': {'sport': 1, 'fun': 1},
+        'durations': {DAYS.half: 1},
+        'age_ranges': {},
+        'weekdays': {0: 1, 2: 1},
+        'municipalities': {'Bern': 1},
+        'available': {'few': 1}
+    }
+
+    # the occasion based filters have to match a single occasion
+    a = scenario.c.activities.for_filter(age_range=(10, 10))
+
+    assert a.facets()['age_ranges'] == {(10, 10): 1}
+    assert a.facets()['tags'] == {'dance': 1, 'fun': 1}
+    assert a.facets()['weekdays'] == {2: 1}
+
+    a = a.for_filter(weekday=0)
+
+    assert a.facets()['age_ranges'] == {}
+    assert a.facets()['weekdays'] == {2: 1}
+    assert a.facets()['tags'] == {}
+
+    # activities without occasions have no occasion based facets
+    a = scenario.c.activities.for_filter(timeline='undated')
+
+    assert a.facets() == {
+        'tags': {'fun': 1},
+        'durations': {},
+        'age_ranges': {},
+        'weekdays': {},
+        'municipalities': {'Bern': 1},
+        'available': {}
+    }
+
+
 def test_timeline_filter(scenario):
     with freeze_time('2018-02-01'):
         scenario.add_period(active=False)
@@ -1,5 +1,8 @@
+from datetime import datetime
+from onegov.activity.utils import dates_overlap, intervals_overlap
 from onegov.activity.utils import merge_ranges
 from onegov.activity.utils import extract_municipality
+from sedate import replace_timezone
 
 
 def test_merge_ranges():
@@ -27,3 +30,44 @@ def test_extract_municipality():
 
     assert extract_municipality("0123 invalid plz") is None
     assert extract_municipality("4653 Obergösgen") == (4653, "Obergösgen")
+
+
+def test_dates_overlap():
+
+    def dt(hour, minute=0, day=1):
+        return replace_timezone(datetime(2019, 7, day, hour, minute), 'UTC')
+
+    morning = ((dt(9), dt(11)), (dt(9, day=2), dt(11, day=2)))
+    noon = ((dt(11), dt(13)), )
+    evening = ((dt(18), dt(20)), (dt(18, day=2), dt(20, day=2)))
+
+    assert not dates_overlap(morning, noon)
+    assert not dates_overlap(noon, evening)
+    assert not dates_overlap(morning, evening)
+
+    assert dates_overlap(morning, noon, minutes_between=30)
+    assert dates_overlap(morning, evening, alignment='day')
+    assert dates_overlap(noon, ((dt(8), dt(9)), (dt(12), dt(14))))
+
+    # dates without a duration are points, which overlap with the dates
+    # containing them, but not with each other
+    point = ((dt(10), dt(10)), )
+
+    assert dates_overlap(point, morning)
+    assert dates_overlap(morning, point)
+    assert not dates_overlap(point, point)
+    assert not dates_overlap(point, noon)
+
+
+def test_intervals_overlap():
+    assert not intervals_overlap((), ((1, 2), ))
+    assert intervals_overlap(((1, 2), ), ((2, 3), ))
+    assert not intervals_overlap(((1, 2), (5, 6)), ((3, 4), (7, 8)))
+    assert intervals_overlap(((1, 2), (5, 6)), ((3, 4), (6, 8)))
+    assert intervals_overlap(((1, 9), ), ((2, 3), (4, 5)))
+
+    # inverted intervals
+    assert intervals_overlap(((3, 2), ), ((1, 5), ))
+    assert intervals_overlap(((1, 5), ), ((3, 2), ))
+    assert not intervals_overlap(((3, 2), ), ((3, 2), ))
+    assert intervals_overlap(((3, 2), ), ((3, 4), (3, 2)))
@@ -12,6 +12,7 @@ from onegov.activity import InvoiceCollection
 from onegov.activity import InvoiceItem
 from onegov.activity import InvoiceReference
 from onegov.activity import Occasion
+from onegov.activity import OccasionSearch
 from onegov.activity import Period
 from onegov.activity import PeriodCollection
 from onegov.core.crypto import random_token
@@ -697,3 +698,8 @@ def add_age_barrier_type(context):
         column=Column('age_barrier_type', Text),
         default='exact'
     )
+
+
+@upgrade_task('Fill the occasion search table')
+def fill_occasion_search_table(context):
+    OccasionSearch.refresh(context.session)
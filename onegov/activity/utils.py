@@ -4,7 +4,7 @@ import re
 import sedate
 import string
 
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 from functools import partial
 from pyquery import PyQuery as pq
 
@@ -22,6 +22,8 @@ MUNICIPALITY_EX = re.compile(r"""
 
 GROUP_CODE_EX = re.compile(r'[A-Z]{3}-?[A-Z]{3}-?[A-Z]{3}')
 
+EPOCH = sedate.replace_timezone(datetime(1970, 1, 1), 'UTC')
+
 
 def random_group_code():
     # 26^9 should be a decent amount of codes to randomly chose, without
@@ -164,41 +166,169 @@ def dates_overlap(a, b, minutes_between=0, cut_end=True, alignment=None):
     with a time tuple in b.
 
     """
-    # this can be done with an O(n log n) algorithm but since we are
-    # operating on a very small n the constant factors dominate and there
-    # are fewer constant factors in this approach:
+
+    return intervals_overlap(
+        padded_intervals(a, minutes_between, alignment),
+        padded_intervals(b, minutes_between, alignment)
+    )
+
+
+def as_microseconds(value):
+    """ Turns the given date or datetime into an integer, keeping the order
+    between values of the same kind intact.
+
+    """
+
+    if isinstance(value, datetime):
+        epoch = value.tzinfo and EPOCH or EPOCH.replace(tzinfo=None)
+        return (value - epoch) // timedelta(microseconds=1)
+
+    return value.toordinal() * 86400 * 1000000
+
+
+def padded_intervals(dates, minutes_between=0, alignment=None):
+    """ Returns the given (start, end) tuples as integer intervals, with the
+    padding and the alignment of :func:`dates_overlap` applied.
+
+    Two lists of such intervals overlap, if and only if the dates they were
+    created from overlap according to :func:`dates_overlap`. See
+    :func:`intervals_overlap`.
+
+    """
 
     offset = timedelta(seconds=minutes_between / 2 * 60)
-    ms = cut_end and timedelta(microseconds=1) or timedelta()
 
     # make sure that 11:00 - 12:00 and 12:00 - 13:00 are not overlapping
     ms = timedelta(microseconds=1)
 
     if alignment:
-
-        # alignment function
         align = getattr(sedate, f'align_range_to_{alignment}')
 
-        # it is highliy unlikely that this will ever be anything else as this
+        # it is highly unlikely that this will ever be anything else as this
         # module is pretty much tailored for Switzerland
         align = partial(align, timezone='Europe/Zurich')
 
-    for s, e in a:
-        for os, oe in b:
+    intervals = []
 
-            if alignment:
-                s, e = align(s, e)
-                os, oe = align(os, oe)
+    for s, e in dates:
+        if alignment:
+            s, e = align(s, e)
 
-            if sedate.overlaps(
-                s - offset, e + offset - ms,
-                os - offset, oe + offset - ms
-            ):
-                return True
+        intervals.append((
+            as_microseconds(s - offset),
+            as_microseconds(e + offset - ms)
+        ))
+
+    # inverted intervals (dates without a duration) sort after the others
+    intervals.sort(key=lambda i: (i[0], i[1] < i[0]))
+
+    return tuple(intervals)
+
+
+def intervals_overlap(a, b):
+    """ Returns true if any interval in a overlaps with an interval in b.
+
+    The intervals are expected to be created by :func:`padded_intervals`,
+    which returns them sorted by start. This allows for a sweep over both
+    lists, advancing the interval which ends first.
+
+    An inverted interval (end before start) is treated like the point at
+    its start. Such a point overlaps with the intervals containing it, but
+    never with another point.
+
+    """
+
+    i = j = 0
+
+    while i < len(a) and j < len(b):
+        s, e = a[i]
+        os, oe = b[j]
+
+        point, other_point = e < s, oe < os
+
+        if point:
+            e = s
+
+        if other_point:
+            oe = os
+
+        if max(s, os) <= min(e, oe) and not (point and other_point):
+            return True
+
+        if e < oe:
+            i += 1
+        else:
+            j += 1
 
     return False
 
 
+def occasion_intervals(occasion, minutes_between=0, alignment=None):
+    """ Returns the dates of the given occasion as sorted integer intervals,
+    padded and aligned according to the given period settings (see
+    :func:`padded_intervals`).
+
+    The intervals are memoised on the occasion, per settings. Occasions
+    whose dates change are expected to reset ``_intervals``, which the
+    :class:`~onegov.activity.models.Occasion` model does through events.
+
+    """
+
+    key = (minutes_between, alignment)
+
+    try:
+        return occasion._intervals[key]
+    except (AttributeError, TypeError, KeyError):
+        pass
+
+    # loading the dates may reset the intervals, so they are stored after
+    intervals = padded_intervals(
+        ((d.start, d.end) for d in occasion.dates),
+        minutes_between, alignment)
+
+    if getattr(occasion, '_intervals', None) is None:
+        occasion._intervals = {}
+
+    occasion._intervals[key] = intervals
+
+    return intervals
+
+
+def booking_overlaps(booking, other, minutes_between=0, alignment=None,
+                     with_anti_affinity_check=False):
+    """ Returns true if the given booking overlaps with the given booking
+    or occasion.
+
+    """
+
+    # even if exclude_from_overlap_check is active we consider a booking
+    # to overlap itself (this protects against double bookings)
+    if booking.id == other.id:
+        return True
+
+    if hasattr(other, 'occasion'):
+        other_occasion = other.occasion
+    else:
+        other_occasion = other
+
+    if with_anti_affinity_check:
+        if other_occasion.anti_affinity_group is not None:
+            if booking.occasion.anti_affinity_group \
+                    == other_occasion.anti_affinity_group:
+                return True
+
+    if booking.occasion.exclude_from_overlap_check:
+        return False
+
+    if other_occasion.exclude_from_overlap_check:
+        return False
+
+    return intervals_overlap(
+        occasion_intervals(booking.occasion, minutes_between, alignment),
+        occasion_intervals(other_occasion, minutes_between, alignment)
+    )
+
+
 def is_internal_image(url):
     return url and INTERNAL_IMAGE_EX.match(url) and True or False
 